@@ -21,10 +21,19 @@ import httpclient
 import http.server
 import threading
 import socketserver
+import socket
 import random
 import time
 import urllib.parse
 import json
+import asyncio
+import io
+import contextlib
+import tracemalloc
+import tempfile
+import os
+import gzip
+import zlib
 
 BASEHOST = '127.0.0.1'
 BASEPORT = 27600 + random.randint(1,100)
@@ -59,6 +68,14 @@ class MyHTTPHandler(http.server.BaseHTTPRequestHandler):
             print("Exception %s\n" % e)
             raise e
 
+# answers every GET with ok on a kept-alive HTTP/1.1 connection
+class KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    def do_GET(self):
+        self.wfile.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+    def log_message(self, format, *args):
+        pass
+
 def make_http_server(host = BASEHOST, port = BASEPORT):
     return http.server.HTTPServer( (host, port) , MyHTTPHandler)
 
@@ -84,6 +101,153 @@ def echo_post(self):
     self.end_headers()
     self.wfile.write(bytes(json.dumps(post_data),"utf-8"))
 
+# repeats your path back in chunks, one per path segment
+def chunked_path_get(self):
+    self.send_response(200)
+    self.send_header("Content-type", "text/plain")
+    self.send_header("Transfer-Encoding", "chunked")
+    self.end_headers()
+    for part in self.path.split("/"):
+        data = bytes("%s/" % part,"utf-8")
+        self.wfile.write(bytes("%x\r\n" % len(data),"utf-8") + data + b"\r\n")
+    self.wfile.write(b"0\r\nX-Trailer: done\r\n\r\n")
+
+# repeats your path back many times, gzipped if you accept it or deflated for /deflate
+def compressed_path_get(self):
+    data = bytes(self.path * 200,"utf-8")
+    self.send_response(200)
+    self.send_header("Content-type", "text/plain")
+    if self.path.startswith("/deflate"):
+        data = zlib.compress(data)
+        self.send_header("Content-Encoding", "deflate")
+    elif "gzip" in (self.headers['Accept-Encoding'] or ""):
+        data = gzip.compress(data)
+        self.send_header("Content-Encoding", "gzip")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+# repeats your path back with an ETag, answering 304 when it still matches,
+# and fresh for a minute under /fresh, with every byte value as the body under /fresh/binary
+def etag_path_get(self):
+    etag = '"%x"' % len(self.path)
+    if self.headers['If-None-Match'] == etag:
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.end_headers()
+        return
+    data = bytes(self.path,"utf-8")
+    self.send_response(200)
+    if self.path.startswith("/fresh/binary"):
+        data = bytes(range(256))
+        self.send_header("Content-type", "application/octet-stream")
+    else:
+        self.send_header("Content-type", "text/plain")
+    self.send_header("ETag", etag)
+    if self.path.startswith("/fresh"):
+        self.send_header("Cache-Control", "max-age=60")
+    else:
+        self.send_header("Cache-Control", "no-cache")
+    self.end_headers()
+    self.wfile.write(data)
+
+# /CODE/N/rest redirects with CODE to /CODE/N-1/rest until N is 0,
+# then repeats your method, path and body back, and /https redirects to https
+def redirect_path(self):
+    length = int(self.headers['Content-Length'] or 0)
+    data = self.rfile.read(length).decode('utf-8')
+    if self.path.startswith("/https"):
+        self.send_response(301)
+        self.send_header("Location", "https://%s%s" % (self.headers['Host'], self.path))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        return
+    _, code, hops, rest = self.path.split("/", 3)
+    if int(hops) > 0:
+        self.send_response(int(code))
+        self.send_header("Location", "../%d/%s" % (int(hops) - 1, rest))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        return
+    self.send_response(200)
+    self.send_header("Content-type", "text/plain")
+    self.end_headers()
+    self.wfile.write(bytes("%s %s %s" % (self.command, self.path, data),"utf-8"))
+
+# answers 503 until it has been asked /flaky/N N times, then repeats your path back
+def flaky_path(self):
+    key = (self.command, self.path)
+    flaky_path.calls[key] = flaky_path.calls.get(key, 0) + 1
+    if flaky_path.calls[key] <= int(self.path.split("/")[2]):
+        self.send_response(503)
+        self.send_header("Retry-After", "0")
+        self.end_headers()
+        return
+    echo_path_get(self)
+flaky_path.calls = {}
+
+# repeats your path back as latin-1, or as a json string under /json
+def charset_path_get(self):
+    self.send_response(200)
+    if self.path.startswith("/json"):
+        self.send_header("Content-type", "application/json")
+        data = bytes(json.dumps({"path": self.path}),"utf-8")
+    else:
+        self.send_header("Content-type", "text/plain; charset=ISO-8859-1")
+        data = bytes("%s \u00e9\u00ff" % self.path,"latin-1")
+    self.end_headers()
+    self.wfile.write(data)
+
+# serves RANGE_BODY, or the byte range asked for, cut short after range_get.limit bytes,
+# or an empty file under /empty
+RANGE_BODY = bytes(range(256)) * 1200
+def range_get(self):
+    data = RANGE_BODY
+    if self.path.startswith("/empty"):
+        self.send_response(416)
+        self.send_header("Content-Range", "bytes */0")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        return
+    if self.headers['Range'] and not self.path.startswith("/norange"):
+        start, end = self.headers['Range'].split("=")[1].split("-")
+        start, end = int(start), int(end or len(data) - 1)
+        self.send_response(206)
+        self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, len(data)))
+        data = data[start:end + 1]
+    else:
+        self.send_response(200)
+    self.send_header("Accept-Ranges", "bytes")
+    self.send_header("ETag", '"v1"')
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data[:range_get.limit])
+range_get.limit = None
+
+# repeats your headers back as json
+def echo_headers(self):
+    self.send_response(200)
+    self.send_header("Content-type", "application/json")
+    self.end_headers()
+    self.wfile.write(bytes(json.dumps(dict(self.headers.items())),"utf-8"))
+
+# repeats your raw post body back, chunked or not
+def echo_body(self):
+    if self.headers['Transfer-Encoding'] == 'chunked':
+        data = b''
+        size = int(self.rfile.readline(), 16)
+        while size:
+            data += self.rfile.read(size)
+            self.rfile.readline()
+            size = int(self.rfile.readline(), 16)
+        self.rfile.readline()
+    else:
+        data = self.rfile.read(int(self.headers['Content-Length']))
+    self.send_response(200)
+    self.send_header("Content-type", "application/octet-stream")
+    self.end_headers()
+    self.wfile.write(data)
+
 def header_check(self):
     response = 200
     errors = []
@@ -182,6 +346,547 @@ class TestHTTPClient(unittest.TestCase):
         self.assertTrue(req.code == 200)
         self.assertTrue(req.body.find(path)>=0, "Data: [%s] " % req.body)
 
+    def testHeaders(self):
+        '''Test repeated, case-insensitive and awkward header lines'''
+        MyHTTPHandler.get = echo_path_get
+        http = httpclass.HTTPClient()
+        req = http.GET("http://%s:%d/headers" % (BASEHOST,BASEPORT))
+        self.assertTrue(req.headers['content-type'] == "text/plain", req.headers)
+        block = (b"Set-Cookie: a=1\r\nset-cookie: b=2\r\nX-Note: time: 12:00\r\n"
+                 b"X-Tight:value\r\nX-Folded: one\r\n  two")
+        headers = httpclass.Headers.parse(block)
+        self.assertTrue(headers.get_all('SET-COOKIE') == ['a=1', 'b=2'], headers)
+        self.assertTrue(headers['x-note'] == 'time: 12:00', headers)
+        self.assertTrue(headers['X-Tight'] == 'value', headers)
+        self.assertTrue(headers['x-folded'] == 'one two', headers)
+        self.assertRaises(httpclass.ProtocolError, httpclass.Headers.parse, block, 2)
+        # lookups before the headers are split only match whole names, first value first
+        headers = httpclass.Headers.parse(block)
+        self.assertTrue(headers['SET-cookie'] == 'a=1' and headers.get('note') is None, headers)
+        self.assertTrue('x-tight' in headers and 'tight' not in headers, headers)
+        self.assertRaises(KeyError, headers.__getitem__, 'cookie')
+        # a header added before the first lookup is indexed with the parsed ones
+        headers = httpclass.Headers.parse(block)
+        headers.add('X-Added', '1')
+        self.assertTrue(len(headers) == 6 and headers['x-added'] == '1', headers)
+
+    def testRequestHeaders(self):
+        '''Test that caller headers are sent and replace the defaults'''
+        MyHTTPHandler.get = echo_headers
+        http = httpclass.HTTPClient()
+        url = "http://%s:%d/headers?a=b" % (BASEHOST,BASEPORT)
+        for i in range(2):
+            req = http.GET(url, headers={'User-Agent': 'freetests', 'X-Request': str(i)})
+            self.assertTrue(req.code == 200)
+            sent = json.loads(req.body)
+            self.assertTrue(sent['User-Agent'] == 'freetests', sent)
+            self.assertTrue(sent['X-Request'] == str(i), sent)
+            self.assertTrue(sent['Host'] == "%s:%d" % (BASEHOST,BASEPORT), sent)
+
+    def testChunkedGET(self):
+        '''Test HTTP GET with a chunked response'''
+        MyHTTPHandler.get = chunked_path_get
+        http = httpclass.HTTPClient()
+        path = "abcdef/gjkd/dsadas"
+        url = "http://%s:%d/%s" % (BASEHOST,BASEPORT, path)
+        req = http.GET( url )
+        self.assertTrue(req != None, "None Returned!")
+        self.assertTrue(req.code == 200)
+        self.assertTrue(req.body == "/%s/" % path, "Data: [%s] " % req.body)
+
+    def testCompressedGET(self):
+        '''Test HTTP GET with gzip and deflate bodies'''
+        MyHTTPHandler.get = compressed_path_get
+        http = httpclass.HTTPClient()
+        path = "abcdef/gjkd/dsadas"
+        url = "http://%s:%d/%s" % (BASEHOST,BASEPORT, path)
+        req = http.GET( url )
+        self.assertTrue(req.code == 200)
+        self.assertTrue(req.body == "/%s" % path * 200, "Data: [%s] " % req.body[:100])
+        self.assertTrue(req.raw_bytes < req.decoded_bytes, (req.raw_bytes, req.decoded_bytes))
+        req = httpclass.HTTPClient(decompress=False).GET( url )
+        self.assertTrue(req.raw_bytes == req.decoded_bytes == len(req.body))
+        url = "http://%s:%d/deflate/%s" % (BASEHOST,BASEPORT, path)
+        req = http.GET( url, stream=True )
+        out = io.BytesIO()
+        req.write_to(out, chunk_size=4)
+        self.assertTrue(out.getvalue() == bytes("/deflate/%s" % path * 200,"utf-8"))
+        self.assertTrue(req.raw_bytes < req.decoded_bytes == len(out.getvalue()))
+
+    def testCache(self):
+        '''Test GETs answered from the cache, revalidated, evicted and kept on disk'''
+        MyHTTPHandler.get = etag_path_get
+        cache = httpclass.ResponseCache()
+        http = httpclass.HTTPClient(cache=cache)
+        url = "http://%s:%d/abcdef/gjkd" % (BASEHOST,BASEPORT)
+        fresh = "http://%s:%d/fresh/abcdef" % (BASEHOST,BASEPORT)
+        for i in range(3):
+            req = http.GET( url )
+            self.assertTrue(req.code == 200 and req.body == "/abcdef/gjkd", "Data: [%s] " % req.body)
+            req = http.GET( fresh )
+            self.assertTrue(req.code == 200 and req.body == "/fresh/abcdef", "Data: [%s] " % req.body)
+        stats = cache.stats()
+        self.assertTrue(stats['misses'] == 2 and stats['revalidations'] == 2 and stats['hits'] == 2, stats)
+        small = httpclass.ResponseCache(max_bytes=cache.stats()['bytes'] - 1)
+        small.store(url, None, http.GET( url ))
+        small.store(fresh, None, http.GET( fresh ))
+        self.assertTrue(small.stats()['evictions'] == 1 and small.lookup(url) is None)
+        with tempfile.TemporaryDirectory() as directory:
+            httpclass.HTTPClient(cache=httpclass.ResponseCache(directory=directory)).GET( fresh )
+            cache = httpclass.ResponseCache(directory=directory)
+            req = httpclass.HTTPClient(cache=cache).GET( fresh )
+            self.assertTrue(req.body == "/fresh/abcdef" and cache.stats()['hits'] == 1, cache.stats())
+            binary = "http://%s:%d/fresh/binary" % (BASEHOST,BASEPORT)
+            httpclass.HTTPClient(cache=httpclass.ResponseCache(directory=directory)).GET( binary )
+            for http in [httpclass.HTTPClient(cache=httpclass.ResponseCache(directory=directory))] * 2:
+                self.assertTrue(http.GET( binary ).content == bytes(range(256)))
+            self.assertTrue(http.cache.stats()['hits'] == 2, http.cache.stats())
+
+    def testRedirects(self):
+        '''Test following redirects with the method rewritten as the status asks'''
+        MyHTTPHandler.get = redirect_path
+        MyHTTPHandler.post = redirect_path
+        http = httpclass.HTTPClient()
+        url = "http://%s:%d/302/3/abcdef" % (BASEHOST,BASEPORT)
+        req = http.GET( url )
+        self.assertTrue(req.code == 200 and req.body == "GET /302/0/abcdef ", "Data: [%s] " % req.body)
+        self.assertTrue([r.code for r in req.redirects] == [302, 302, 302])
+        self.assertTrue(req.url == "http://%s:%d/302/0/abcdef" % (BASEHOST,BASEPORT), req.url)
+        self.assertTrue(all(r.elapsed is not None for r in req.redirects))
+        req = http.POST( "http://%s:%d/303/1/abcdef" % (BASEHOST,BASEPORT), body=b"data" )
+        self.assertTrue(req.body == "GET /303/0/abcdef ", "Data: [%s] " % req.body)
+        req = http.POST( "http://%s:%d/307/1/abcdef" % (BASEHOST,BASEPORT), body=b"data" )
+        self.assertTrue(req.body == "POST /307/0/abcdef data", "Data: [%s] " % req.body)
+        req = http.GET( "http://%s:%d/301/30/abcdef" % (BASEHOST,BASEPORT), stream=True )
+        self.assertTrue(req.code == 301 and len(req.redirects) == 10)
+        req.close()
+        req = httpclass.HTTPClient(max_redirects=0).GET( url )
+        self.assertTrue(req.code == 302 and req.redirects == [])
+        req = http.GET( "http://%s:%d/https/abcdef" % (BASEHOST,BASEPORT) )
+        self.assertTrue(req.code == 301 and req.redirects == [], req.code)
+        self.assertTrue(req.headers['Location'].startswith("https://"))
+
+    def testTimings(self):
+        '''Test the timings on a response and the hooks around a request'''
+        MyHTTPHandler.get = chunked_path_get
+        http = httpclass.HTTPClient(retry=httpclass.Retry(max_attempts=1))
+        events = []
+        for event in httpclass.HTTPClient.HOOKS:
+            http.add_hook(event, lambda *args, event=event: events.append(event))
+        url = "http://%s:%d/abcdef/gjkd" % (BASEHOST,BASEPORT)
+        req = http.GET( url )
+        self.assertTrue(events == ['request', 'connect', 'headers', 'done'], events)
+        timings = req.timings.as_dict()
+        self.assertTrue(all(timings[phase] is not None for phase in httpclass.Timings.PHASES), timings)
+        self.assertTrue(timings['received_bytes'] > len(req.body) and timings['sent_bytes'] > 0, timings)
+        self.assertTrue(timings['reused'] is False)
+        del events[:]
+        req = http.GET( url, stream=True )
+        self.assertTrue(events == ['request', 'connect', 'headers'] and req.timings.total is None, events)
+        req.read()
+        self.assertTrue(events[-1] == 'done' and req.timings.total is not None, events)
+        del events[:]
+        http.GET( "http://%s:%d/abcdef" % (BASEHOST,1) )
+        self.assertTrue(events == ['request', 'error'], events)
+        self.assertRaises(ValueError, http.add_hook, 'sent', print)
+
+    def testBench(self):
+        '''Test the load generator against the local server'''
+        MyHTTPHandler.get = echo_path_get
+        url = "http://%s:%d/abcdef" % (BASEHOST,BASEPORT)
+        stats = httpclass.bench( url, concurrency=2, requests=20 )
+        self.assertTrue(stats['requests'] == 20 and stats['errors'] == 0, stats)
+        self.assertTrue(stats['status'] == {200: 20}, stats)
+        self.assertTrue(stats['p50'] <= stats['p90'] <= stats['p99'] <= stats['max'], stats)
+        self.assertTrue(stats['bytes'] > 0)
+        self.assertTrue("20 in" in httpclass.format_bench(stats))
+        # every request measured is one the server saw, none hidden by retries
+        MyHTTPHandler.get = flaky_path
+        stats = httpclass.bench( "http://%s:%d/flaky/1000/bench" % (BASEHOST,BASEPORT), concurrency=2, requests=20 )
+        self.assertTrue(stats['status'] == {503: 20}, stats)
+        self.assertTrue(flaky_path.calls[("GET", "/flaky/1000/bench")] == 20, flaky_path.calls)
+        self.assertTrue(httpclass.percentile([1, 2, 3, 4], 50) == 2)
+        self.assertTrue(httpclass.percentile([1, 2, 3, 4], 99) == 4)
+
+    def testCrawl(self):
+        '''Test crawling a list of urls across processes into JSON lines'''
+        MyHTTPHandler.get = echo_path_get
+        urls = ["http://%s:%d/crawl/%d\n" % (BASEHOST,BASEPORT,i) for i in range(20)]
+        urls += ["# a comment\n", "\n", "http://%s:%d/crawl\n" % (BASEHOST,1)]
+        out = io.StringIO()
+        summary = httpclass.crawl( iter(urls), out, processes=2, threads=2 )
+        self.assertTrue(summary == {'urls': 21, 'errors': 1}, summary)
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        ok = sorted(result['url'] for result in results if result.get('code') == 200)
+        self.assertTrue(ok == sorted(url.strip() for url in urls[:20]), ok)
+        self.assertTrue(sum(1 for result in results if 'error' in result) == 1)
+
+    def testCrawlManyHosts(self):
+        '''Test crawling more distinct hosts than the process may have files open'''
+        import resource
+        # a keep-alive server on every loopback address, so each host keeps its connection
+        server = http.server.ThreadingHTTPServer(("0.0.0.0", 0), KeepAliveHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port = server.server_address[1]
+        urls = ["http://127.0.%d.%d:%d/crawl\n" % (i // 200, i % 200 + 1, port) for i in range(600)]
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (512, hard))
+        try:
+            out = io.StringIO()
+            summary = httpclass.crawl( iter(urls), out, processes=1, threads=4 )
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+            server.shutdown()
+            server.server_close()
+        self.assertTrue(summary == {'urls': 600, 'errors': 0}, summary)
+
+    def testHostScheduler(self):
+        '''Test per-host rates, caps, backoff and taking turns between hosts'''
+        scheduler = httpclass.HostScheduler(rate=20, burst=1)
+        start = time.monotonic()
+        for i in range(5):
+            scheduler.acquire("a")
+            scheduler.release("a", httpclass.HTTPResponse(200))
+        self.assertTrue(time.monotonic() - start >= 0.18, time.monotonic() - start)
+        throttled = httpclass.HTTPResponse(429, headers=httpclass.Headers([("Retry-After", "0.2")]))
+        scheduler.acquire("b")
+        scheduler.release("b", throttled)
+        stats = scheduler.stats()
+        self.assertTrue(stats['throttled'] == 1 and stats['hosts']['b']['paused'] > 0.1, stats)
+        self.assertTrue(stats['hosts']['b']['rate'] == 10, stats)
+        start = time.monotonic()
+        scheduler.acquire("b")
+        scheduler.release("b", None)
+        self.assertTrue(time.monotonic() - start >= 0.15)
+
+        # a single slot shared by two hosts: b gets its turn before a's second request
+        scheduler = httpclass.HostScheduler(max_total=1)
+        order = []
+        def request(host):
+            scheduler.acquire(host)
+            order.append(host)
+            scheduler.release(host, httpclass.HTTPResponse(200))
+        scheduler.acquire("a")
+        threads = []
+        for host in ["a", "a", "b"]:
+            threads.append(threading.Thread(target=request, args=(host,)))
+            threads[-1].start()
+            while scheduler.stats()['queued'] < len(threads):
+                time.sleep(0.001)
+        scheduler.release("a")
+        for thread in threads:
+            thread.join()
+        self.assertTrue(order == ["a", "b", "a"], order)
+        self.assertTrue(scheduler.stats()['wait_max'] > 0)
+
+        MyHTTPHandler.get = echo_path_get
+        scheduler = httpclass.HostScheduler(max_in_flight=1)
+        http = httpclass.HTTPClient(scheduler=scheduler)
+        req = http.GET( "http://%s:%d/abcdef" % (BASEHOST,BASEPORT) )
+        self.assertTrue(req.code == 200 and scheduler.stats()['started'] == 1)
+
+    def testRetry(self):
+        '''Test retrying failed idempotent requests and unsent POSTs'''
+        MyHTTPHandler.get = flaky_path
+        MyHTTPHandler.post = flaky_path
+        retry = httpclass.Retry(backoff=0.01)
+        http = httpclass.HTTPClient(retry=retry)
+        req = http.GET( "http://%s:%d/flaky/2/get" % (BASEHOST,BASEPORT) )
+        self.assertTrue(req.code == 200 and req.attempts == 3, (req.code, req.attempts))
+        req = http.GET( "http://%s:%d/flaky/5/get" % (BASEHOST,BASEPORT) )
+        self.assertTrue(req.code == 503 and req.attempts == 3, (req.code, req.attempts))
+        req = http.POST( "http://%s:%d/flaky/1/post" % (BASEHOST,BASEPORT), body=b"data" )
+        self.assertTrue(req.code == 503 and req.attempts == 1, (req.code, req.attempts))
+        req = http.POST( "http://%s:%d/flaky" % (BASEHOST,1), body=b"data" )
+        self.assertTrue(req.error is not None and req.attempts == 3, (req.error, req.attempts))
+        self.assertTrue(retry.stats()['retries'] == 6, retry.stats())
+        # retrying is opt in
+        req = httpclass.HTTPClient().GET( "http://%s:%d/flaky/1/again" % (BASEHOST,BASEPORT) )
+        self.assertTrue(req.code == 503 and req.attempts == 1, (req.code, req.attempts))
+
+        # a pooled connection the server had closed is retried at once, unless a POST was sent on it
+        stale = httpclass.HTTPResponse(500)
+        stale.error = ConnectionResetError()
+        stale.timings = httpclass.Timings()
+        stale.timings.reused = True
+        stale.timings.sent_bytes = 100
+        self.assertTrue(retry.delay("GET", 1, stale) == 0.0)
+        self.assertTrue(retry.delay("POST", 1, stale) is None)
+        self.assertTrue(retry.delay("GET", 3, stale) is None)
+        once = httpclass.Retry(max_attempts=1)
+        self.assertTrue(once.delay("GET", 1, stale) == 0.0 and once.delay("GET", 2, stale) is None)
+        self.assertTrue(once.delay("GET", 1, error=httpclass.ReadTimeout()) is None)
+        self.assertTrue(retry.delay("GET", 1, error=httpclass.DeadlineExceeded()) is None)
+        spent = httpclass.Retry(budget=0, reserve=1)
+        self.assertTrue(spent.delay("GET", 1, error=httpclass.ReadTimeout()) is not None)
+        self.assertTrue(spent.delay("GET", 1, error=httpclass.ReadTimeout()) is None)
+
+    def testResponseDecoding(self):
+        '''Test decoding the body with its charset, as JSON and as raw bytes'''
+        MyHTTPHandler.get = charset_path_get
+        http = httpclass.HTTPClient()
+        req = http.GET( "http://%s:%d/abcdef" % (BASEHOST,BASEPORT) )
+        self.assertTrue(req.code == 200)
+        self.assertTrue(req.content == b"/abcdef \xe9\xff", req.content)
+        self.assertTrue(req.encoding == "iso-8859-1" and req.text == "/abcdef \u00e9\u00ff", req.text)
+        self.assertTrue(req.body == req.text)
+        req = http.GET( "http://%s:%d/json/abcdef" % (BASEHOST,BASEPORT) )
+        self.assertTrue(req.json() == {"path": "/json/abcdef"}, req.body)
+        req = http.GET( "http://%s:%d/json/abcdef" % (BASEHOST,BASEPORT), stream=True )
+        self.assertTrue(req.json() == {"path": "/json/abcdef"})
+        self.assertRaises(AttributeError, setattr, httpclass.HTTPResponse(), "extra", 1)
+
+    def testDownload(self):
+        '''Test downloading in parallel ranges, resuming and falling back to one stream'''
+        MyHTTPHandler.get = range_get
+        url = "http://%s:%d/file" % (BASEHOST,BASEPORT)
+        with tempfile.TemporaryDirectory() as directory:
+            path = directory + "/file"
+            range_get.limit = 1000
+            try:
+                self.assertRaises(httpclass.HTTPClientError, httpclass.download, url, path, min_segment=65536)
+            finally:
+                range_get.limit = None
+            with open(path + ".progress") as f:
+                progress = json.load(f)
+            self.assertTrue(len(progress['segments']) == 4, progress)
+            summary = httpclass.download( url, path, min_segment=65536 )
+            self.assertTrue(summary['segments'] == 4 and 0 < summary['resumed'] < len(RANGE_BODY), summary)
+            with open(path, "rb") as f:
+                self.assertTrue(f.read() == RANGE_BODY)
+            self.assertTrue(not os.path.exists(path + ".progress"))
+            url = "http://%s:%d/norange/file" % (BASEHOST,BASEPORT)
+            summary = httpclass.download( url, path + "2" )
+            self.assertTrue(summary['segments'] == 1 and summary['bytes'] == len(RANGE_BODY), summary)
+            with open(path + "2", "rb") as f:
+                self.assertTrue(f.read() == RANGE_BODY)
+            with open(path + "3", "wb") as f:
+                f.write(RANGE_BODY * 3)
+            httpclass.download( "http://%s:%d/file" % (BASEHOST,BASEPORT), path + "3", min_segment=65536 )
+            with open(path + "3", "rb") as f:
+                self.assertTrue(f.read() == RANGE_BODY)
+            summary = httpclass.download( "http://%s:%d/empty/file" % (BASEHOST,BASEPORT), path + "4" )
+            self.assertTrue(summary['bytes'] == 0 and os.path.getsize(path + "4") == 0, summary)
+
+    def testDaemon(self):
+        '''Test sending requests from the command line through a daemon on a Unix socket'''
+        MyHTTPHandler.get = echo_path_get
+        MyHTTPHandler.post = echo_post
+        url = "http://%s:%d/daemon/abcdef" % (BASEHOST,BASEPORT)
+        with tempfile.TemporaryDirectory() as directory:
+            path = directory + "/daemon.sock"
+            with open(directory + "/file", "w") as f:
+                f.write("kept")
+            self.assertRaises(httpclass.HTTPClientError, httpclass.serve, directory + "/file")
+            with open(directory + "/file") as f:
+                self.assertTrue(f.read() == "kept")
+            # only a socket owned by this user in a directory others cannot change is trusted
+            self.assertRaises(httpclass.HTTPClientError, httpclass.daemon_request, directory + "/file", "GET", url)
+            os.mkdir(directory + "/shared")
+            os.chmod(directory + "/shared", 0o777)
+            self.assertRaises(httpclass.HTTPClientError, httpclass.daemon_request, directory + "/shared/daemon.sock", "GET", url)
+            self.assertRaises(httpclass.HTTPClientError, httpclass.serve, directory + "/shared/daemon.sock")
+            self.assertTrue(httpclass.daemon_request(path, "GET", url) is None)
+            self.assertTrue(httpclass.daemon_request(directory + "/missing/daemon.sock", "GET", url) is None)
+            path = directory + "/private/daemon.sock"
+            daemon = threading.Thread(target=httpclass.serve, args=(path,), kwargs={'idle': 1.0})
+            daemon.start()
+            while not os.path.exists(path):
+                time.sleep(0.01)
+            self.assertTrue(os.stat(directory + "/private").st_mode & 0o777 == 0o700)
+            req = httpclass.daemon_request(path, "GET", url)
+            self.assertTrue(req.code == 200 and req.error is None, req.code)
+            self.assertTrue(req.body == "/daemon/abcdef\n", req.body)
+            self.assertTrue(req.headers['Content-Type'] == "text/plain")
+            self.assertTrue(req.timings.total is not None)
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                status = httpclass.main(["-d", "a=aaa", "--socket", path, "http://%s:%d/post_echoer" % (BASEHOST,BASEPORT)])
+            self.assertTrue(status == 0)
+            self.assertTrue(json.loads(out.getvalue()[len("200 "):])['a'][0] == 'aaa', out.getvalue())
+            # a failure goes to stderr only, leaving stdout clean for a pipeline
+            closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            closed.bind((BASEHOST, 0))
+            out, err = io.StringIO(), io.StringIO()
+            with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+                status = httpclass.main(["http://%s:%d/refused" % closed.getsockname()])
+            closed.close()
+            self.assertTrue(status == 1 and out.getvalue() == "" and "ConnectionRefusedError" in err.getvalue(), out.getvalue())
+            daemon.join()
+            self.assertTrue(not os.path.exists(path))
+
+    def testStreamGET(self):
+        '''Test HTTP GET with the body streamed to a file'''
+        MyHTTPHandler.get = chunked_path_get
+        http = httpclass.HTTPClient()
+        path = "abcdef/gjkd/dsadas"
+        url = "http://%s:%d/%s" % (BASEHOST,BASEPORT, path)
+        req = http.GET( url, stream=True )
+        self.assertTrue(req != None, "None Returned!")
+        self.assertTrue(req.code == 200)
+        out = io.BytesIO()
+        req.write_to(out, chunk_size=4)
+        self.assertTrue(out.getvalue() == bytes("/%s/" % path,"utf-8"), out.getvalue())
+
+    def testAsyncGather(self):
+        '''Test concurrent GETs and a POST with the asyncio client'''
+        MyHTTPHandler.get = echo_path_get
+        MyHTTPHandler.post = echo_post
+        http = httpclass.AsyncHTTPClient()
+        urls = ["http://%s:%d/async/%d" % (BASEHOST,BASEPORT,i) for i in range(8)]
+        post = ("http://%s:%d/post_echoer" % (BASEHOST,BASEPORT), "POST", {'a':'aaa'})
+        reqs = asyncio.run(http.gather(urls + [post], limit=3))
+        self.assertTrue(len(reqs) == 9)
+        for i in range(8):
+            self.assertTrue(reqs[i].code == 200)
+            self.assertTrue(reqs[i].body.find("/async/%d" % i)>=0, "Data: [%s] " % reqs[i].body)
+        self.assertTrue(json.loads(reqs[8].body)['a'][0] == 'aaa', reqs[8].body)
+
+    def testAsyncLoops(self):
+        '''Test reusing the asyncio client from a second event loop'''
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind((BASEHOST, 0))
+        listener.listen(8)
+        # a keep-alive server, answering every request on a connection until it is closed
+        def answer(conn):
+            with conn:
+                while conn.recv(65536):
+                    conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+        def serve():
+            while True:
+                try:
+                    conn, _ = listener.accept()
+                except OSError:
+                    return
+                threading.Thread(target=answer, args=(conn,), daemon=True).start()
+        thread = threading.Thread(target=serve)
+        thread.start()
+        http = httpclass.AsyncHTTPClient()
+        url = "http://%s:%d/loops" % listener.getsockname()
+        try:
+            for i in range(2):
+                reqs = asyncio.run(http.gather([url] * 3, limit=1))
+                self.assertTrue([req.code for req in reqs] == [200] * 3, [req.code for req in reqs])
+                self.assertTrue(http.pool.stats()['hits'] == 2 * (i + 1), http.pool.stats())
+        finally:
+            http.close()
+            listener.shutdown(socket.SHUT_RDWR)
+            thread.join()
+            listener.close()
+
+    def testFetchMany(self):
+        '''Test concurrent GETs sharing one client across threads'''
+        MyHTTPHandler.get = echo_path_get
+        http = httpclass.HTTPClient()
+        urls = ["http://%s:%d/threaded/%d" % (BASEHOST,BASEPORT,i) for i in range(8)]
+        reqs = list(http.fetch_many(urls, max_workers=4, timeout=5))
+        self.assertTrue(len(reqs) == 8)
+        for req in reqs:
+            self.assertTrue(req.code == 200)
+            self.assertTrue(req.body.find(urllib.parse.urlparse(req.url).path)>=0, "Data: [%s] " % req.body)
+
+    def testPipeline(self):
+        '''Test pipelined GETs fall back when the server closes after each response'''
+        MyHTTPHandler.get = echo_path_get
+        http = httpclass.HTTPClient()
+        urls = ["http://%s:%d/pipelined/%d" % (BASEHOST,BASEPORT,i) for i in range(5)]
+        reqs = http.pipeline(urls, depth=3)
+        self.assertTrue(len(reqs) == 5)
+        for i in range(5):
+            self.assertTrue(reqs[i].code == 200)
+            self.assertTrue(reqs[i].body.find("/pipelined/%d" % i)>=0, "Data: [%s] " % reqs[i].body)
+
+    def testPipelineClosed(self):
+        '''Test a pipelined GET to a server that closes without answering gives up'''
+        closing = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        closing.bind((BASEHOST, 0))
+        closing.listen(8)
+        accepted = []
+        def serve():
+            while True:
+                try:
+                    conn, _ = closing.accept()
+                except OSError:
+                    return
+                accepted.append(conn)
+                conn.recv(65536)
+                conn.close()
+        thread = threading.Thread(target=serve)
+        thread.start()
+        http = httpclass.HTTPClient(retry=httpclass.Retry(max_attempts=1))
+        reqs = http.pipeline(["http://%s:%d/closed" % closing.getsockname()])
+        # wakes the accept() in serve()
+        closing.shutdown(socket.SHUT_RDWR)
+        thread.join()
+        closing.close()
+        self.assertTrue(len(reqs) == 1 and reqs[0].code == 500 and reqs[0].error is not None, reqs)
+        self.assertTrue(len(accepted) == 2, len(accepted))
+
+    def testReadTimeout(self):
+        '''Test that a server that never answers raises a ReadTimeout'''
+        silent = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        silent.bind((BASEHOST, 0))
+        silent.listen(1)
+        http = httpclass.HTTPClient(timeout=httpclass.Timeout(connect=1, read=0.2), retry=httpclass.Retry(max_attempts=1))
+        url = "http://%s:%d/silent" % silent.getsockname()
+        self.assertRaises(httpclass.ReadTimeout, http.GET, url)
+        self.assertRaises(httpclass.RequestTimeout, http.GET, url, timeout=httpclass.Timeout(total=0.2))
+        self.assertTrue(http.timeouts['read'] == 1, http.timeouts)
+        self.assertTrue(http.timeouts['total'] == 1, http.timeouts)
+        silent.close()
+
+    def testManyDescriptors(self):
+        '''Test connecting and reusing connections once descriptors pass FD_SETSIZE'''
+        MyHTTPHandler.get = echo_path_get
+        files = []
+        try:
+            while len(files) < 1100:
+                files.append(open(os.devnull))
+        except OSError:
+            for f in files:
+                f.close()
+            self.skipTest("cannot open 1100 files")
+        try:
+            http = httpclass.HTTPClient()
+            url = "http://%s:%d/many/fds" % (BASEHOST,BASEPORT)
+            req = http.GET( url )
+            self.assertTrue(req.code == 200 and req.error is None, req.error)
+            ours, theirs = socket.socketpair()
+            self.assertTrue(ours.fileno() > 1024 and http.pool.is_healthy(ours))
+            theirs.close()
+            self.assertTrue(not http.pool.is_healthy(ours))
+            ours.close()
+        finally:
+            for f in files:
+                f.close()
+
+    def testResolver(self):
+        '''Test the DNS cache and falling back between address families'''
+        MyHTTPHandler.get = echo_path_get
+        lookups = []
+        def lookup(host, port):
+            lookups.append(host)
+            if host == "nowhere.invalid":
+                raise socket.gaierror("not found")
+            # nothing listens on this IPv6 address so the IPv4 one has to win
+            return [(socket.AF_INET6, ("::1", 1, 0, 0)), (socket.AF_INET, (BASEHOST, port))]
+        resolver = httpclass.Resolver(lookup=lookup)
+        http = httpclass.HTTPClient(keep_alive=False, resolver=resolver)
+        for i in range(2):
+            req = http.GET("http://example.test:%d/resolved" % BASEPORT)
+            self.assertTrue(req.code == 200)
+            self.assertTrue(req.body.find("/resolved")>=0, "Data: [%s] " % req.body)
+        for i in range(2):
+            self.assertRaises(socket.gaierror, resolver.resolve, "nowhere.invalid", 80)
+        self.assertTrue(lookups == ["example.test", "nowhere.invalid"], lookups)
+        self.assertTrue(resolver.hits == 2 and resolver.misses == 2)
+        # the cache keeps at most max_entries lookups, the oldest makes room
+        resolver = httpclass.Resolver(lookup=lookup, max_entries=2)
+        for host in ["a.test", "b.test", "c.test", "c.test", "a.test"]:
+            resolver.resolve(host, 80)
+        self.assertTrue(lookups[-4:] == ["a.test", "b.test", "c.test", "a.test"], lookups)
+
     def testGETHeaders(self):
         '''Test HTTP GET Headers'''
         MyHTTPHandler.get = header_check
@@ -256,6 +961,91 @@ class TestHTTPClient(unittest.TestCase):
         for key in outargs:
             self.assertTrue(args[key] == outargs[key][0], "Key [%s] not found" % key)
 
+    def testConnectionPool(self):
+        '''Test that the pool reuses live sockets and evicts dead ones'''
+        pool = httpclass.ConnectionPool(max_size=1)
+        self.assertTrue(pool.acquire(BASEHOST, BASEPORT) == None)
+        ours, theirs = socket.socketpair()
+        pool.release(BASEHOST, BASEPORT, ours)
+        self.assertTrue(pool.acquire(BASEHOST, BASEPORT) is ours)
+        # the pool only keeps max_size idle sockets per origin
+        extra, other = socket.socketpair()
+        pool.release(BASEHOST, BASEPORT, ours)
+        pool.release(BASEHOST, BASEPORT, extra)
+        # a socket closed by the peer fails the health check
+        theirs.close()
+        self.assertTrue(pool.acquire(BASEHOST, BASEPORT) == None)
+        stats = pool.stats()
+        self.assertTrue(stats['hits'] == 1, stats)
+        self.assertTrue(stats['misses'] == 2, stats)
+        self.assertTrue(stats['evictions'] == 2, stats)
+        other.close()
+        # idle sockets of every origin expire, and only max_total are kept across origins
+        pool = httpclass.ConnectionPool(idle_timeout=0.1, max_total=50)
+        pairs = [socket.socketpair() for i in range(80)]
+        for i, (ours, theirs) in enumerate(pairs):
+            pool.release("origin%d.test" % i, 80, ours)
+        stats = pool.stats()
+        self.assertTrue(stats['idle'] == 50 and stats['evictions'] == 30, stats)
+        self.assertTrue(pool.acquire("origin0.test", 80) is None and pool.acquire("origin79.test", 80) is pairs[79][0])
+        time.sleep(0.2)
+        pool.release("origin79.test", 80, pairs[79][0])
+        stats = pool.stats()
+        self.assertTrue(stats['idle'] == 1 and stats['evictions'] == 79, stats)
+        pool.close()
+        for ours, theirs in pairs:
+            theirs.close()
+
+    def testResponseParser(self):
+        '''Test framing when the header terminator spans two reads'''
+        parser = httpclass.ResponseParser()
+        body = b''
+        for part in [b'HTTP/1.1 200 OK\r\nContent-Length: 5\r', b'\n\r\nhel', b'loHTTP/1.1']:
+            for piece in parser.feed(part):
+                body += piece
+        self.assertTrue(parser.done)
+        self.assertTrue(parser.code == 200)
+        self.assertTrue(body == b'hello', body)
+        self.assertTrue(parser.unused == b'HTTP/1.1', parser.unused)
+        self.assertTrue(parser.keep_alive)
+
+    def testReceiveLength(self):
+        '''Test that a body past the preallocated size grows as it arrives'''
+        http = httpclass.HTTPClient()
+        http.PREALLOCATE = 1000
+        body = bytes(random.getrandbits(8) for i in range(100000))
+        ours, theirs = socket.socketpair()
+        theirs.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 100000\r\n\r\n' + body)
+        parser, received = http.recvall(ours)
+        self.assertTrue(parser.done and received == body)
+        # a Content-Length the server never sends is not allocated up front
+        tracemalloc.start()
+        theirs.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 100000000000\r\n\r\nshort')
+        theirs.close()
+        self.assertRaises(httpclass.ProtocolError, httpclass.HTTPClient().recvall, ours)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        ours.close()
+        self.assertTrue(peak < 32 * 1024 * 1024, peak)
+
+    def testPOSTBodies(self):
+        '''Test POST with file, generator and bytes bodies'''
+        MyHTTPHandler.post = echo_body
+        http = httpclass.HTTPClient()
+        url = "http://%s:%d/body" % (BASEHOST,BASEPORT)
+        data = bytes(range(256)) * 1000
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.seek(1000)
+            req = http.POST(url, body=f, stream=True)
+            self.assertTrue(req.code == 200)
+            self.assertTrue(req.read() == data[1000:])
+        req = http.request("POST", url, body=(bytes([i]) * 1000 for i in range(100)), stream=True)
+        self.assertTrue(req.code == 200)
+        self.assertTrue(req.read() == b''.join(bytes([i]) * 1000 for i in range(100)))
+        req = http.POST(url, body=b'raw bytes')
+        self.assertTrue(req.body == 'raw bytes', req.body)
+
     @classmethod
     def tearDownClass(self):        
         if (TestHTTPClient.httpd!=None):
@@ -17,41 +17,2488 @@
 # Write your own HTTP GET and POST
 # The point is to understand what you have to send and get experience with it
 
-import json
+# asyncio, concurrent.futures, email.utils, hashlib, json, queue and random are
+# imported where they are used, so a one-off request from the command line does
+# not pay for loading them
+import collections
+import errno
 import re
 import sys
+import select
 import socket
+import threading
+import time
+import zlib
+from stat import S_ISREG, S_ISSOCK, S_ISVTX
 # you may use urllib to encode data appropriately
-from urllib.parse import urlparse, parse_qs, urlencode
+from urllib.parse import urlparse, urljoin, parse_qs, urlencode
 
-from datetime import datetime
 import sys, os
 
 def help():
-    print("httpclient.py [GET/POST] [URL]\n")
+    print("httpclient.py [METHOD] [URL] [-X METHOD] [-H 'NAME: VALUE'] [-d DATA] [-t SECONDS] [-m SECONDS] [-v]")
+    print("httpclient.py [METHOD] [URL] --daemon [--socket PATH]")
+    print("httpclient.py daemon [SOCKET] [--idle SECONDS]")
+    print("httpclient.py bench [URL] [-c CONCURRENCY] [-n REQUESTS | -d SECONDS] [--no-keep-alive]")
+    print("httpclient.py crawl [FILE] [-o OUTPUT] [-p PROCESSES] [-c CONCURRENCY] [--delay SECONDS] [--per-host N]")
+    print("httpclient.py [URL] -o FILE [-s SEGMENTS]\n")
 
 class HTTPResponse(object):
-    def __init__(self, code=200, body=""):
+    '''
+        A response that keeps the body as the bytes received. The text, the JSON and
+        the headers are only decoded or parsed when first asked for, and then kept.
+
+        Args:
+            code    (int)               :   The status code
+            body    (bytes or str)      :   The body, a bytearray or memoryview is kept without copying
+            url     (str)               :   The requested url
+            headers (Headers or bytes)  :   The headers, or the raw header block to parse on first use
+    '''
+    __slots__ = ('code', 'url', 'error', 'raw_bytes', 'decoded_bytes', 'redirects', 'elapsed', 'timings',
+                 'attempts', '_content', '_text', '_headers', '_head')
+
+    CHARSET = re.compile(r'charset\s*=\s*"?([^";\s]+)', re.I)
+
+    def __init__(self, code=200, body=b'', url=None, headers=None):
         self.code = code
-        self.body = body
+        self.url = url
+        if isinstance(body, str):
+            self._content = None
+            self._text = body
+        else:
+            self._content = body
+            self._text = None
+        if isinstance(headers, (bytes, bytearray)):
+            self._headers = None
+            self._head = headers
+        else:
+            self._headers = headers
+            self._head = None
+        self.error = None
+        self.raw_bytes = None
+        self.decoded_bytes = None
+        self.redirects = ()
+        self.elapsed = None
+        self.timings = None
+        self.attempts = 1
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            # the parser that read the head has already checked the number of lines
+            self._headers = Headers.parse(self._head, sys.maxsize) if self._head else Headers()
+            self._head = None
+        return self._headers
+
+    @property
+    def content(self):
+        '''
+            The body as bytes, or the bytearray or memoryview it was received into
+        '''
+        if self._content is None:
+            self._content = (self._text or '').encode(self.encoding)
+        return self._content
+
+    @property
+    def encoding(self):
+        '''
+            The charset named in the Content-Type header, UTF-8 if there is none
+        '''
+        match = self.CHARSET.search(self.headers.get('content-type', ''))
+        return match.group(1).lower() if match else 'utf-8'
+
+    @property
+    def text(self):
+        '''
+            The body decoded with its charset, undecodable bytes are replaced
+        '''
+        if self._text is None:
+            content = self.content
+            try:
+                self._text = str(content, self.encoding, 'replace')
+            except LookupError:
+                self._text = str(content, 'utf-8', 'replace')
+        return self._text
+
+    @property
+    def body(self):
+        return self.text
+
+    def json(self):
+        '''
+            Parses the body as JSON
+
+            Returns:
+                value   (object)    :   The parsed body
+        '''
+        import json
+        if self._content is None and self._text is not None:
+            return json.loads(self._text)
+        content = self.content
+        return json.loads(content.tobytes() if isinstance(content, memoryview) else content)
 
     def __str__(self):
         return f'{self.code} {self.body}'
 
-class HTTPClient(object):
-    #def get_host_port(self,url):
+class HTTPClientError(Exception):
+    '''
+        Base class for the errors raised by the client
+    '''
+
+class ProtocolError(HTTPClientError):
+    '''
+        Raised when the server sends a response that cannot be parsed or framed
+    '''
+
+class Headers(object):
+    '''
+        A case-insensitive header map that keeps every value of a repeated
+        header, such as Set-Cookie, in the order they were received.
+        Indexing returns the first value, get_all returns every value. Parsed
+        headers are kept as text: looking one up searches the lowercased text,
+        and the text is only split into names and values, and indexed by
+        lowercase name, once every header is needed or the headers change.
+
+        Args:
+            items   (list)  :   (name, value) pairs to start with
+    '''
+    def __init__(self, items=()):
+        self._text = None
+        self._lower = None
+        self._items = []
+        self._index = {}
+        for name, value in items:
+            self.add(name, value)
+
+    @classmethod
+    def parse(cls, block, max_count=100):
+        '''
+            Parses a header block. Obsolete folded lines are joined onto the header
+            they continue and the lines are counted here, splitting each line is left
+            until every header is needed.
+
+            Args:
+                block       (bytes) :   The header lines, without the status line or the blank line after them
+                max_count   (int)   :   The most header lines allowed
+
+            Returns:
+                headers (Headers)   :   The parsed headers
+        '''
+        text = bytes(block).decode('iso-8859-1')
+        if '\r\n ' in text or '\r\n\t' in text:
+            # obs-fold, a line starting with whitespace continues the previous value
+            text = re.sub(r'\r\n[ \t]+', ' ', text)
+        if text.count('\r\n') >= max_count:
+            raise ProtocolError('too many response headers')
+        headers = cls()
+        # led by a line break so every header name follows one
+        headers._text = '\r\n' + text
+        headers._items = None
+        headers._index = None
+        return headers
+
+    def pairs(self):
+        '''
+            Returns the (name, value) pairs, splitting the parsed lines on first use
+        '''
+        items = self._items
+        if items is None:
+            items = []
+            for line in self._text.split('\r\n'):
+                name, sep, value = line.partition(':')
+                if sep:
+                    items.append((name, value.strip()))
+            self._items = items
+        return items
+
+    def index(self):
+        '''
+            Returns the values of each header keyed by lowercase name, building it on first use
+        '''
+        index = self._index
+        if index is None:
+            index = {}
+            for name, value in self.pairs():
+                key = name.lower()
+                values = index.get(key)
+                if values is None:
+                    index[key] = [value]
+                else:
+                    values.append(value)
+            self._index = index
+        return index
+
+    def find(self, name):
+        '''
+            Finds the first value of a header in the parsed text without splitting it
+
+            Args:
+                name    (str)   :   The header name
+
+            Returns:
+                value   (str)   :   The value, or None if there is no such header
+        '''
+        lower = self._lower
+        if lower is None:
+            # lowercasing iso-8859-1 text keeps its length, so offsets carry over
+            lower = self._lower = self._text.lower()
+        needle = '\r\n' + name.lower() + ':'
+        start = lower.find(needle)
+        if start < 0:
+            return None
+        start += len(needle)
+        end = lower.find('\r\n', start)
+        return self._text[start:end if end >= 0 else None].strip()
+
+    def add(self, name, value):
+        self.pairs().append((name, value))
+        if self._index is not None:
+            self._index.setdefault(name.lower(), []).append(value)
+
+    def get(self, name, default=None):
+        if self._items is None:
+            value = self.find(name)
+            return default if value is None else value
+        values = self.index().get(name.lower())
+        return values[0] if values else default
+
+    def get_all(self, name):
+        return list(self.index().get(name.lower(), ()))
+
+    def __getitem__(self, name):
+        if self._items is None:
+            value = self.find(name)
+            if value is None:
+                raise KeyError(name)
+            return value
+        values = self.index().get(name.lower())
+        if not values:
+            raise KeyError(name)
+        return values[0]
+
+    def __contains__(self, name):
+        if self._items is None:
+            return self.find(name) is not None
+        return name.lower() in self.index()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.pairs())
+
+    def keys(self):
+        return [name for name, _ in self.pairs()]
+
+    def items(self):
+        return list(self.pairs())
+
+    def __repr__(self):
+        return f'Headers({self.pairs()!r})'
+
+class RequestTimeout(HTTPClientError):
+    '''
+        Raised when a request runs out of time, the subclass says which limit was hit
+    '''
+
+class ConnectTimeout(RequestTimeout):
+    '''
+        Raised when the TCP connection is not made within the connect timeout
+    '''
+
+class ReadTimeout(RequestTimeout):
+    '''
+        Raised when the server sends nothing for longer than the read timeout
+    '''
+
+class DeadlineExceeded(RequestTimeout):
+    '''
+        Raised when the whole request takes longer than the total timeout
+    '''
+
+class Timeout(object):
+    '''
+        The time limits of a request, in seconds. None means no limit.
+
+        Args:
+            connect (float) :   Seconds to wait for the TCP connection
+            read    (float) :   Seconds to wait on each send or receive once connected
+            total   (float) :   Seconds the whole request may take, from connecting to the last body byte
+    '''
+    def __init__(self, connect=None, read=None, total=None):
+        self.connect = connect
+        self.read = read
+        self.total = total
+
+    @classmethod
+    def coerce(cls, timeout):
+        '''
+            Turns a number into a Timeout used for both connecting and reading
+
+            Args:
+                timeout (Timeout or float)  :   The timeout given by the caller
+
+            Returns:
+                timeout (Timeout)   :   The timeout as a Timeout
+        '''
+        if isinstance(timeout, Timeout):
+            return timeout
+        return cls(timeout, timeout)
+
+class Timings(object):
+    '''
+        How long each phase of one request took, in seconds, and the bytes it moved.
+        dns and connect are 0 on a reused connection, ttfb runs from the request being
+        written to the first byte of the response, headers from there to the end of the
+        headers, and body from there to the end of the body. body and total stay None
+        until the body of a streamed response has been consumed.
+
+        Hooks set on_headers to be called with the status code and headers, and
+        on_done to be called once the body has been received.
+    '''
+    PHASES = ('dns', 'connect', 'ttfb', 'headers', 'body', 'total')
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.dns = 0.0
+        self.connect = 0.0
+        self.ttfb = None
+        self.headers = None
+        self.body = None
+        self.total = None
+        self.sent_bytes = 0
+        self.received_bytes = 0
+        self.reused = False
+        self.on_headers = None
+        self.on_done = None
+        self._mark = self.started
+
+    def lap(self):
+        '''
+            Returns the seconds since the last lap, or since the request started
+        '''
+        now = time.monotonic()
+        elapsed = now - self._mark
+        self._mark = now
+        return elapsed
+
+    def received(self, size):
+        if self.ttfb is None:
+            self.ttfb = self.lap()
+        self.received_bytes += size
+
+    def received_headers(self, parser):
+        self.headers = self.lap()
+        if self.on_headers is not None:
+            self.on_headers(parser.code, parser.headers)
+
+    def finish(self):
+        if self.total is not None:
+            return
+        self.body = self.lap()
+        self.total = self._mark - self.started
+        if self.on_done is not None:
+            self.on_done()
+
+    def as_dict(self):
+        '''
+            Returns the timings and counters as a dictionary, for logging or export
+        '''
+        timings = {phase: getattr(self, phase) for phase in self.PHASES}
+        timings.update(sent_bytes=self.sent_bytes, received_bytes=self.received_bytes, reused=self.reused)
+        return timings
+
+    def __repr__(self):
+        return f'Timings({self.as_dict()!r})'
+
+class Deadline(object):
+    '''
+        Applies a Timeout to the socket operations of one request, and records
+        how long each of them took in timings
+
+        Args:
+            timeout     (Timeout)   :   The limits of the request
+            on_timeout  (function)  :   Called with 'connect', 'read' or 'total' when a limit is hit
+    '''
+    def __init__(self, timeout, on_timeout=None):
+        self.timeout = timeout
+        self.on_timeout = on_timeout
+        self.expires = None if timeout.total is None else time.monotonic() + timeout.total
+        self.timings = Timings()
+        self._applied = False
+
+    def remaining(self, limit):
+        '''
+            Returns the socket timeout to use, the smaller of limit and the time left
+
+            Args:
+                limit   (float) :   The connect or read limit, or None
+        '''
+        if self.expires is None:
+            return limit
+        left = self.expires - time.monotonic()
+        if left <= 0:
+            raise self.expired('total')
+        return left if limit is None else min(limit, left)
+
+    def expired(self, phase):
+        '''
+            Records a timeout and returns the error to raise for it
+
+            Args:
+                phase   (str)   :   'connect', 'read' or 'total'
+
+            Returns:
+                error   (RequestTimeout)    :   The error for the limit that was hit
+        '''
+        if self.expires is not None and time.monotonic() >= self.expires:
+            phase = 'total'
+        if self.on_timeout is not None:
+            self.on_timeout(phase)
+        error = {'connect': ConnectTimeout, 'read': ReadTimeout, 'total': DeadlineExceeded}[phase]
+        return error(f'{phase} timeout')
+
+    def connect(self, resolver, host, port):
+        '''
+            Opens a connection to the host within the connect timeout
+
+            Args:
+                resolver    (Resolver)  :   The resolver to look the host up with
+                host        (str)       :   The host to connect to
+                port        (int)       :   The port to connect to
+
+            Returns:
+                sock    (socket)    :   The connected socket
+        '''
+        self.timings.lap()
+        addresses = resolver.resolve(host, port)
+        self.timings.dns = self.timings.lap()
+        try:
+            sock = resolver.create_connection(host, port, self.remaining(self.timeout.connect), addresses)
+        except socket.timeout:
+            raise self.expired('connect')
+        self.timings.connect = self.timings.lap()
+        self._applied = False
+        return sock
+
+    def arm(self, sock):
+        '''
+            Sets the socket timeout for the next send or receive
+        '''
+        if self.expires is not None or not self._applied:
+            sock.settimeout(self.remaining(self.timeout.read))
+            self._applied = True
+
+    def sendmsg(self, sock, parts):
+        '''
+            Sends every part with scatter/gather I/O, without joining them first
+
+            Args:
+                sock    (socket)    :   The socket to send on
+                parts   (list)      :   The bytes to send, in order
+        '''
+        views = [memoryview(part) for part in parts if part]
+        while views:
+            self.arm(sock)
+            try:
+                if hasattr(sock, 'sendmsg'):
+                    sent = sock.sendmsg(views)
+                else:
+                    sock.sendall(views[0])
+                    sent = len(views[0])
+            except socket.timeout:
+                raise self.expired('read')
+            self.timings.sent_bytes += sent
+            # drop what was sent, sendmsg may stop part way through a buffer
+            while sent:
+                if sent >= len(views[0]):
+                    sent -= len(views.pop(0))
+                else:
+                    views[0] = views[0][sent:]
+                    sent = 0
+        self.timings.lap()
+
+    def sendfile(self, sock, fileobj, count):
+        '''
+            Sends count bytes of a file from its current position, zero-copy where the OS allows
+        '''
+        self.arm(sock)
+        try:
+            sent = sock.sendfile(fileobj, fileobj.tell(), count)
+        except socket.timeout:
+            raise self.expired('read')
+        self.timings.sent_bytes += sent
+        self.timings.lap()
+        if sent != count:
+            raise HTTPClientError(f'request body ended after {sent} of {count} bytes')
+
+    def recv_into(self, sock, view):
+        self.arm(sock)
+        try:
+            size = sock.recv_into(view)
+        except socket.timeout:
+            raise self.expired('read')
+        self.timings.received(size)
+        return size
+
+class Resolver(object):
+    '''
+        Resolves host names with an in-process cache and connects to the results
+        the happy eyeballs way, racing IPv6 and IPv4 addresses.
+
+        References:
+            - https://datatracker.ietf.org/doc/html/rfc8305
+
+        Args:
+            ttl             (float)     :   Seconds a successful lookup is cached
+            negative_ttl    (float)     :   Seconds a failed lookup is cached
+            lookup          (function)  :   Called with (host, port) and returns a list of (family, sockaddr),
+                                            defaults to socket.getaddrinfo
+            delay           (float)     :   Seconds to wait on one address before also trying the next
+            max_entries     (int)       :   The most lookups cached, expired ones and then the oldest make room
+    '''
+    def __init__(self, ttl=60.0, negative_ttl=5.0, lookup=None, delay=0.25, max_entries=1024):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lookup = lookup if lookup is not None else self.getaddrinfo
+        self.delay = delay
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def getaddrinfo(self, host, port):
+        return [(family, sockaddr) for family, _, _, _, sockaddr
+                in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)]
+
+    def resolve(self, host, port):
+        '''
+            Looks up the addresses of a host, from the cache when it is fresh
+
+            Args:
+                host    (str)   :   The host to look up
+                port    (int)   :   The port to connect to
+
+            Returns:
+                addresses   (list)  :   (family, sockaddr) pairs, in the order to try them
+        '''
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get((host, port))
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                if isinstance(entry[1], Exception):
+                    raise entry[1]
+                return entry[1]
+            self.misses += 1
+
+        try:
+            addresses = self.interleave(self.lookup(host, port))
+        except OSError as e:
+            self.store((host, port), (now + self.negative_ttl, e), now)
+            raise
+        self.store((host, port), (now + self.ttl, addresses), now)
+        return addresses
+
+    def store(self, key, entry, now):
+        '''
+            Caches a lookup, keeping the cache within max_entries
+
+            Args:
+                key     (tuple) :   The (host, port) looked up
+                entry   (tuple) :   The time the entry expires and the addresses or error
+                now     (float) :   The current monotonic time
+        '''
+        with self._lock:
+            # a refreshed entry moves to the end, so the first is always the oldest
+            self._cache.pop(key, None)
+            if len(self._cache) >= self.max_entries:
+                for old in [old for old, (expires, _) in self._cache.items() if expires <= now]:
+                    del self._cache[old]
+                while self._cache and len(self._cache) >= self.max_entries:
+                    del self._cache[next(iter(self._cache))]
+            if self.max_entries > 0:
+                self._cache[key] = entry
+
+    def interleave(self, addresses):
+        '''
+            Alternates address families, starting with the family of the first address
+        '''
+        if not addresses:
+            raise socket.gaierror('no addresses found')
+        first = [address for address in addresses if address[0] == addresses[0][0]]
+        rest = [address for address in addresses if address[0] != addresses[0][0]]
+        ordered = []
+        for i in range(max(len(first), len(rest))):
+            ordered.extend(first[i:i + 1] + rest[i:i + 1])
+        return ordered
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def create_connection(self, host, port, timeout=None, addresses=None):
+        '''
+            Connects to the host. A new attempt starts every delay seconds, or as soon as
+            one fails, and the first to connect wins while the others are closed.
+
+            Args:
+                host        (str)   :   The host to connect to
+                port        (int)   :   The port to connect to
+                timeout     (float) :   Seconds to wait for a connection, or None to wait forever
+                addresses   (list)  :   The addresses to try, as returned by resolve, looked up if None
+
+            Returns:
+                sock    (socket)    :   The connected, blocking socket
+        '''
+        addresses = list(self.resolve(host, port) if addresses is None else addresses)
+        expires = None if timeout is None else time.monotonic() + timeout
+        pending = {}
+        # poll rather than select, which cannot watch descriptors above FD_SETSIZE
+        poller = select.poll()
+        error = None
+        next_attempt = time.monotonic()
+        try:
+            while addresses or pending:
+                now = time.monotonic()
+                if expires is not None and now >= expires:
+                    raise socket.timeout('timed out')
+                if addresses and (now >= next_attempt or not pending):
+                    family, sockaddr = addresses.pop(0)
+                    try:
+                        sock = socket.socket(family, socket.SOCK_STREAM)
+                    except OSError as e:
+                        # the family is not supported on this machine
+                        error = e
+                        continue
+                    sock.setblocking(False)
+                    result = sock.connect_ex(sockaddr)
+                    if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                        sock.close()
+                        error = OSError(result, os.strerror(result))
+                        continue
+                    pending[sock.fileno()] = sock
+                    poller.register(sock, select.POLLOUT)
+                    next_attempt = now + self.delay
+
+                wait = max(0, next_attempt - now) if addresses else None
+                if expires is not None:
+                    wait = expires - now if wait is None else min(wait, expires - now)
+                for fd, _ in poller.poll(None if wait is None else wait * 1000):
+                    sock = pending.pop(fd)
+                    poller.unregister(fd)
+                    result = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if result == 0:
+                        sock.setblocking(True)
+                        return sock
+                    sock.close()
+                    error = OSError(result, os.strerror(result))
+                    # a failure starts the next attempt straight away
+                    next_attempt = time.monotonic()
+        finally:
+            for sock in pending.values():
+                sock.close()
+        raise error
+
+class ResponseParser(object):
+    '''
+        Incremental HTTP/1.x response parser. Bytes are fed in as they arrive and
+        the parser moves through the status line, the headers and the body,
+        handing back the body pieces that each read produced. Chunked bodies are
+        decoded as they stream in, only a partial chunk-size or trailer line is
+        ever buffered.
+
+        References:
+            - https://datatracker.ietf.org/doc/html/rfc7230#section-3.3.3
+            - https://datatracker.ietf.org/doc/html/rfc7230#section-4.1
+
+        Args:
+            method      (str)   :   The method of the request, a HEAD response never has a body
+            max_header  (int)   :   The maximum size in bytes of the status line and headers
+            max_headers (int)   :   The maximum number of header lines
+    '''
+    STATUS = 'status'
+    HEADERS = 'headers'
+    BODY = 'body'
+    DONE = 'done'
+
+    # the headers read while receiving, the rest are parsed on demand
+    FIELDS = (b'content-length', b'transfer-encoding', b'connection', b'content-encoding')
+
+    def __init__(self, method='GET', max_header=65536, max_headers=100):
+        self.method = method
+        self.max_header = max_header
+        self.max_headers = max_headers
+        self.state = ResponseParser.STATUS
+        self.version = None
+        self.code = None
+        self.reason = None
+        self.head = b''
+        self.fields = {}
+        self.trailers = Headers()
+        self._headers = None
+        self.framing = None
+        self.remaining = None
+        self.unused = b''
+        self.body_bytes = 0
+        self._chunk = 'size'
+        self._pending = bytearray()
+
+    @property
+    def done(self):
+        return self.state == ResponseParser.DONE
+
+    @property
+    def headers(self):
+        '''
+            The response headers, parsed the first time they are asked for
+        '''
+        if self._headers is None:
+            self._headers = Headers.parse(self.head, self.max_headers) if self.head else Headers()
+        return self._headers
+
+    def take_headers(self):
+        '''
+            Returns the headers if they have been parsed, or else the raw header block
+            for a response to parse if they are ever used
+        '''
+        return self._headers if self._headers is not None else self.head
+
+    def field(self, name, default=None):
+        '''
+            Returns one of FIELDS without parsing the rest of the headers. Values are lowercase.
+
+            Args:
+                name    (str)   :   The lowercase header name
+                default (str)   :   The value if the header is not there
+        '''
+        if self._headers is not None:
+            value = self._headers.get(name)
+            return default if value is None else value.lower()
+        return self.fields.get(name, default)
+
+    @property
+    def keep_alive(self):
+        '''
+            Whether the connection can be reused once this response is done
+        '''
+        if not self.done or self.framing == 'close':
+            return False
+        connection = self.field('connection', '')
+        if self.version == 'HTTP/1.1':
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+    def feed(self, data):
+        '''
+            Feeds bytes received from the server into the parser
+
+            Args:
+                data    (bytes)     :   The bytes received from the server, a memoryview is not copied
+
+            Returns:
+                pieces  (list)  :   The body bytes contained in data, in order. These may be
+                                    slices of data so they must be used before data is reused
+        '''
+        pieces = []
+        if self.state == ResponseParser.STATUS or self.state == ResponseParser.HEADERS:
+            self._pending.extend(data)
+            data = self._parse_head()
+            if data is None:
+                return pieces
+        if self.state == ResponseParser.BODY and data:
+            self._parse_body(data, pieces)
+            for piece in pieces:
+                self.body_bytes += len(piece)
+        return pieces
+
+    def advance(self, size):
+        '''
+            Accounts for body bytes the caller read straight into its own buffer,
+            only valid for a body framed by Content-Length
+
+            Args:
+                size    (int)   :   The number of body bytes read
+        '''
+        self.remaining -= size
+        self.body_bytes += size
+        if self.remaining == 0:
+            self.state = ResponseParser.DONE
+
+    def feed_eof(self):
+        '''
+            Tells the parser the server closed the connection
+        '''
+        if self.state == ResponseParser.BODY and self.framing == 'close':
+            self.state = ResponseParser.DONE
+        elif self.state != ResponseParser.DONE:
+            raise ProtocolError('connection closed before the response was complete')
+
+    def _parse_head(self):
+        '''
+            Parses the status line and the headers out of the pending bytes
+
+            Returns:
+                rest    (bytes)     :   The bytes after the headers, or None if the headers are incomplete
+        '''
+        if self.state == ResponseParser.STATUS:
+            end = self._pending.find(b'\r\n')
+            if end < 0:
+                self._check_header_size()
+                return None
+            line = self._pending[:end].decode('iso-8859-1')
+            del self._pending[:end + 2]
+            if not line:
+                # tolerate stray blank lines before the status line
+                return self._parse_head()
+            parts = line.split(' ', 2)
+            if len(parts) < 2 or not parts[0].startswith('HTTP/') or not parts[1].isdigit():
+                raise ProtocolError(f'invalid status line: {line!r}')
+            self.version = parts[0]
+            self.code = int(parts[1])
+            self.reason = parts[2] if len(parts) > 2 else ''
+            self.state = ResponseParser.HEADERS
+
+        if self._pending.startswith(b'\r\n'):
+            end = 0
+            rest = bytes(self._pending[2:])
+        else:
+            end = self._pending.find(b'\r\n\r\n')
+            if end < 0:
+                self._check_header_size()
+                return None
+            rest = bytes(self._pending[end + 4:])
+        if end:
+            self.head = bytes(self._pending[:end])
+            self._scan_head()
+        self._pending = bytearray()
+
+        if 100 <= self.code < 200 and self.code != 101:
+            # an interim response, the real one follows it on the same connection
+            self.__init__(self.method, self.max_header, self.max_headers)
+            self._pending.extend(rest)
+            return self._parse_head()
+
+        self._start_body(rest)
+        return rest
+
+    def _scan_head(self):
+        '''
+            Picks the headers that frame the body out of the raw header block, the
+            rest are only parsed if they are asked for
+        '''
+        block = self.head
+        if block.count(b'\r\n') >= self.max_headers:
+            raise ProtocolError('too many response headers')
+        if b'\r\n ' in block or b'\r\n\t' in block:
+            # a folded line may continue one of the fields, parse it all
+            self.headers
+            return
+        lower = b'\r\n' + block.lower()
+        for name in self.FIELDS:
+            start = lower.find(b'\r\n' + name + b':')
+            if start < 0:
+                continue
+            start += len(name) + 3
+            end = lower.find(b'\r\n', start)
+            self.fields[name.decode('ascii')] = lower[start:end if end >= 0 else len(lower)].strip().decode('iso-8859-1')
+
+    def _check_header_size(self):
+        if len(self._pending) > self.max_header:
+            raise ProtocolError('response headers are too large')
+
+    def _start_body(self, rest):
+        '''
+            Works out how the body is framed from the status code and the headers
+
+            Args:
+                rest    (bytes)     :   The bytes received after the headers
+        '''
+        if self.method == 'HEAD' or self.code in (204, 304):
+            self.framing = 'length'
+            self.remaining = 0
+        elif 'chunked' in self.field('transfer-encoding', ''):
+            self.framing = 'chunked'
+        elif self.field('content-length') is not None:
+            try:
+                self.remaining = int(self.field('content-length'))
+            except ValueError:
+                raise ProtocolError('invalid Content-Length: ' + self.field('content-length'))
+            self.framing = 'length'
+        else:
+            self.framing = 'close'
+
+        if self.framing == 'length' and self.remaining == 0:
+            self.state = ResponseParser.DONE
+            self.unused = bytes(rest)
+        else:
+            self.state = ResponseParser.BODY
+
+    def _parse_body(self, data, pieces):
+        if self.framing == 'close':
+            pieces.append(data)
+            return
+        if self.framing == 'chunked':
+            self._parse_chunked(data, pieces)
+            return
+        if len(data) >= self.remaining:
+            # anything past the body belongs to the next response on the connection
+            self.unused = bytes(data[self.remaining:])
+            data = data[:self.remaining]
+        pieces.append(data)
+        self.remaining -= len(data)
+        if self.remaining == 0:
+            self.state = ResponseParser.DONE
+
+    def _parse_chunked(self, data, pieces):
+        '''
+            Decodes chunked transfer-encoding, moving between the chunk-size line,
+            the chunk data, the CRLF after the data and the trailers
+
+            Args:
+                data    (bytes) :   The bytes received from the server
+                pieces  (list)  :   The list the decoded body pieces are appended to
+        '''
+        pos = 0
+        while pos < len(data) and self.state == ResponseParser.BODY:
+            if self._chunk == 'data':
+                end = min(len(data), pos + self.remaining)
+                pieces.append(data[pos:end])
+                self.remaining -= end - pos
+                pos = end
+                if self.remaining == 0:
+                    self._chunk = 'data_end'
+                continue
+
+            # control lines are short, search a small window so a memoryview is never copied whole
+            window = data[pos:pos + 1024]
+            end = bytes(window).find(b'\n')
+            if end < 0:
+                self._pending.extend(window)
+                self._check_header_size()
+                pos += len(window)
+                continue
+            line = bytes(self._pending + window[:end]).rstrip(b'\r')
+            self._pending = bytearray()
+            pos += end + 1
+
+            if self._chunk == 'size':
+                try:
+                    # chunk extensions after ';' are ignored
+                    self.remaining = int(line.split(b';', 1)[0].strip(), 16)
+                except ValueError:
+                    raise ProtocolError(f'invalid chunk size: {line!r}')
+                self._chunk = 'data' if self.remaining else 'trailers'
+            elif self._chunk == 'data_end':
+                if line:
+                    raise ProtocolError('chunk data is not followed by CRLF')
+                self._chunk = 'size'
+            elif line:
+                key, sep, value = line.decode('iso-8859-1').partition(':')
+                if sep:
+                    if len(self.trailers) >= self.max_headers:
+                        raise ProtocolError('too many response trailers')
+                    self.trailers.add(key.strip(), value.strip())
+            else:
+                self.state = ResponseParser.DONE
+                self.unused = bytes(data[pos:])
+
+class ContentDecoder(object):
+    '''
+        Undoes a gzip or deflate Content-Encoding as the body arrives, with
+        zlib.decompressobj. No single call returns more than max_size bytes,
+        so a small compressed body cannot blow up into one huge buffer.
+
+        References:
+            - https://docs.python.org/3/library/zlib.html#zlib.decompressobj
+
+        Args:
+            encoding    (str)   :   'gzip' or 'deflate'
+            max_size    (int)   :   The most decompressed bytes handed back at once
+    '''
+    ENCODINGS = ('gzip', 'x-gzip', 'deflate')
+
+    def __init__(self, encoding, max_size=1048576):
+        self.encoding = encoding
+        self.max_size = max_size
+        self.compressed = 0
+        self.decompressed = 0
+        wbits = zlib.MAX_WBITS if encoding == 'deflate' else 16 + zlib.MAX_WBITS
+        self._zlib = zlib.decompressobj(wbits)
+        self._started = False
+
+    @classmethod
+    def for_encoding(cls, encoding):
+        '''
+            Returns a decoder for a Content-Encoding, or None if the body is not encoded
+        '''
+        encoding = (encoding or '').strip().lower()
+        if encoding in cls.ENCODINGS:
+            return cls(encoding)
+        return None
+
+    def decompress(self, data):
+        '''
+            Decompresses the next piece of the body
+
+            Args:
+                data    (bytes) :   The next compressed bytes
+
+            Yields:
+                piece   (bytes) :   The decompressed bytes, at most max_size at a time
+        '''
+        self.compressed += len(data)
+        if not self._started and data:
+            self._started = True
+            try:
+                piece = self._zlib.decompress(data, self.max_size)
+            except zlib.error:
+                if self.encoding != 'deflate':
+                    raise ProtocolError('invalid gzip body')
+                # some servers send raw deflate without the zlib wrapper
+                self._zlib = zlib.decompressobj(-zlib.MAX_WBITS)
+                piece = self._zlib.decompress(data, self.max_size)
+        else:
+            try:
+                piece = self._zlib.decompress(data, self.max_size)
+            except zlib.error:
+                raise ProtocolError(f'invalid {self.encoding} body')
+        while True:
+            if piece:
+                self.decompressed += len(piece)
+                yield piece
+            if not self._zlib.unconsumed_tail:
+                break
+            piece = self._zlib.decompress(self._zlib.unconsumed_tail, self.max_size)
+
+    def flush(self):
+        '''
+            Returns whatever is left once the body has ended
+        '''
+        piece = self._zlib.flush()
+        self.decompressed += len(piece)
+        return piece
+
+class ReceiveBuffer(object):
+    '''
+        A reusable receive buffer filled with socket.recv_into. The read size
+        starts small and doubles whenever a read fills the buffer, so large
+        bodies are read in few calls without allocating a new bytes per read.
+
+        References:
+            - https://docs.python.org/3/library/socket.html#socket.socket.recv_into
+
+        Args:
+            size        (int)   :   The initial read size
+            max_size    (int)   :   The largest the read size may grow to
+    '''
+    def __init__(self, size=16384, max_size=1048576):
+        self.max_size = max_size
+        self._view = memoryview(bytearray(size))
+
+    def recv(self, sock, deadline=None):
+        '''
+            Reads from the socket into the buffer
+
+            Args:
+                sock        (socket)    :   The socket to read from
+                deadline    (Deadline)  :   The time limits of the request
+
+            Returns:
+                data    (memoryview)    :   The bytes read, only valid until the next call
+        '''
+        view = self._view
+        size = sock.recv_into(view) if deadline is None else deadline.recv_into(sock, view)
+        if size == len(view) and size < self.max_size:
+            # the old buffer stays alive for as long as the returned view does
+            self._view = memoryview(bytearray(min(size * 2, self.max_size)))
+        return view[:size]
+
+class StreamingHTTPResponse(HTTPResponse):
+    '''
+        A response whose body is read from the socket only as the caller consumes it.
+        The connection goes back to the client once the body has been fully read,
+        or is closed if the caller stops early and calls close().
+
+        Args:
+            parser      (ResponseParser)    :   The parser for the response, past its headers
+            pieces      (generator)         :   The body pieces, as yielded by HTTPClient.iter_body
+            on_release  (function)          :   Called with the keep-alive flag once the body is consumed or abandoned
+    '''
+    __slots__ = ('parser', '_pieces', '_on_release', '_consumed')
+
+    def __init__(self, parser, pieces, on_release):
+        HTTPResponse.__init__(self, parser.code, None, headers=parser.take_headers())
+        self.raw_bytes = 0
+        self.decoded_bytes = 0
+        self.parser = parser
+        self._pieces = pieces
+        self._on_release = on_release
+        self._consumed = False
+
+    def _iter_raw(self):
+        if self._consumed:
+            raise HTTPClientError('response body has already been consumed')
+        self._consumed = True
+        try:
+            for piece in self._pieces:
+                self.decoded_bytes += len(piece)
+                self.raw_bytes = self.parser.body_bytes
+                yield bytes(piece)
+        except BaseException:
+            self._release(False)
+            raise
+        self._release(self.parser.keep_alive)
+
+    def _release(self, keep_alive):
+        if self._on_release is not None:
+            self._on_release(keep_alive)
+            self._on_release = None
+
+    def iter_content(self, chunk_size=None):
+        '''
+            Yields the body as bytes
+
+            Args:
+                chunk_size  (int)   :   The size of each yielded chunk, or None to yield data as it arrives
+        '''
+        if chunk_size is None:
+            yield from self._iter_raw()
+            return
+        buffer = bytearray()
+        for piece in self._iter_raw():
+            buffer.extend(piece)
+            while len(buffer) >= chunk_size:
+                yield bytes(buffer[:chunk_size])
+                del buffer[:chunk_size]
+        if buffer:
+            yield bytes(buffer)
+
+    def iter_lines(self):
+        '''
+            Yields the body line by line as bytes, without the line endings
+        '''
+        pending = b''
+        for piece in self._iter_raw():
+            lines = (pending + piece).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line.rstrip(b'\r')
+        if pending:
+            yield pending.rstrip(b'\r')
+
+    def write_to(self, fileobj, chunk_size=None):
+        '''
+            Writes the body to a binary file object without holding it in memory
+
+            Args:
+                fileobj     (file)  :   The file object to write to
+                chunk_size  (int)   :   The size of each write, or None to write data as it arrives
+
+            Returns:
+                written (int)   :   The number of body bytes written
+        '''
+        written = 0
+        for chunk in self.iter_content(chunk_size):
+            fileobj.write(chunk)
+            written += len(chunk)
+        return written
+
+    def read(self):
+        '''
+            Reads the rest of the body into memory
+
+            Returns:
+                body    (bytes) :   The body of the response
+        '''
+        return b''.join(self._iter_raw())
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = self.read()
+        return self._content
+
+    def close(self):
+        '''
+            Stops reading the body, the connection is closed rather than reused
+        '''
+        self._consumed = True
+        self._pieces.close()
+        self._release(False)
+
+class ConnectionPool(object):
+    '''
+        Keeps idle keep-alive sockets per (host, port) so that repeated requests
+        to the same origin can skip the TCP handshake and teardown. Expired sockets
+        of every origin are swept as the pool is used, and once max_total sockets
+        are idle the one idle the longest makes room for the next.
+
+        Args:
+            max_size        (int)   :   The maximum number of idle sockets kept per (host, port)
+            idle_timeout    (float) :   Seconds an idle socket may sit in the pool before it is evicted
+            max_total       (int)   :   The maximum number of idle sockets kept across all origins
+    '''
+    def __init__(self, max_size=10, idle_timeout=30.0, max_total=100):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_total = max_total
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._idle = {}
+        self._swept = time.monotonic()
+        self._lock = threading.Lock()
+
+    def is_healthy(self, sock):
+        '''
+            Checks that an idle socket can be reused. An idle keep-alive socket
+            should never be readable: if it is, the peer has either closed it or
+            sent data we did not ask for, and either way it must be dropped.
+
+            Args:
+                sock    (socket)    :   The idle socket to check
+
+            Returns:
+                healthy (bool)  :   True if the socket can be reused
+        '''
+        try:
+            if sock.fileno() < 0:
+                return False
+            poller = select.poll()
+            poller.register(sock, select.POLLIN)
+            # data or EOF on an idle socket, or an error or hangup, all mean it cannot be reused
+            return not poller.poll(0)
+        except (OSError, ValueError):
+            return False
+
+    def discard(self, sock):
+        '''
+            Closes a socket that is leaving the pool for good
+
+            Args:
+                sock    (socket)    :   The socket to close
+        '''
+        sock.close()
+
+    def acquire(self, host, port):
+        '''
+            Returns a healthy idle socket for the origin, or None if there is none
+
+            Args:
+                host    (str)   :   The host of the origin
+                port    (int)   :   The port of the origin
+
+            Returns:
+                sock    (socket)    :   A reusable connected socket, or None on a miss
+        '''
+        now = time.monotonic()
+        key = (host, port)
+        with self._lock:
+            self._sweep(now)
+            idle = self._idle.get(key)
+            while idle:
+                sock, last_used = idle.pop()
+                if not idle:
+                    del self._idle[key]
+                if now - last_used > self.idle_timeout or not self.is_healthy(sock):
+                    self.evictions += 1
+                    self.discard(sock)
+                    continue
+                self.hits += 1
+                return sock
+            self.misses += 1
+            return None
+
+    def release(self, host, port, sock):
+        '''
+            Puts a socket back into the pool once its response has been fully read
+
+            Args:
+                host    (str)       :   The host of the origin
+                port    (int)       :   The port of the origin
+                sock    (socket)    :   The socket to return to the pool
+        '''
+        now = time.monotonic()
+        key = (host, port)
+        with self._lock:
+            self._sweep(now)
+            if len(self._idle.get(key, ())) >= self.max_size or self.max_total < 1:
+                self.evictions += 1
+                self.discard(sock)
+                return
+            if sum(len(idle) for idle in self._idle.values()) >= self.max_total:
+                # each list is oldest first, so this is the socket idle the longest
+                oldest = min(self._idle, key=lambda origin: self._idle[origin][0][1])
+                old, _ = self._idle[oldest].pop(0)
+                if not self._idle[oldest]:
+                    del self._idle[oldest]
+                self.evictions += 1
+                self.discard(old)
+            self._idle.setdefault(key, []).append((sock, now))
+
+    def _sweep(self, now):
+        # a scan of every origin at most twice per idle_timeout, not on every call
+        if now - self._swept >= self.idle_timeout / 2:
+            self._evict_expired(now)
+
+    def _evict_expired(self, now):
+        self._swept = now
+        for key in list(self._idle):
+            keep = []
+            for sock, last_used in self._idle[key]:
+                if now - last_used > self.idle_timeout:
+                    self.evictions += 1
+                    self.discard(sock)
+                else:
+                    keep.append((sock, last_used))
+            if keep:
+                self._idle[key] = keep
+            else:
+                del self._idle[key]
+
+    def evict_idle(self):
+        '''
+            Closes every idle socket that has outlived the idle timeout
+        '''
+        with self._lock:
+            self._evict_expired(time.monotonic())
+
+    def close(self):
+        '''
+            Closes every idle socket in the pool
+        '''
+        with self._lock:
+            for idle in self._idle.values():
+                for sock, _ in idle:
+                    self.discard(sock)
+            self._idle.clear()
+
+    def stats(self):
+        '''
+            Returns the pool counters
+
+            Returns:
+                stats   (dict)  :   The hits, misses, evictions and currently idle sockets
+        '''
+        with self._lock:
+            idle = sum(len(socks) for socks in self._idle.values())
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'idle': idle}
+
+class AsyncConnectionPool(ConnectionPool):
+    '''
+        A ConnectionPool of asyncio (reader, writer) stream pairs, for AsyncHTTPClient.
+        Streams belong to the event loop that opened them, so the idle ones are
+        dropped when the pool is first used from a different loop.
+    '''
+    def __init__(self, max_size=10, idle_timeout=30.0, max_total=100):
+        super().__init__(max_size, idle_timeout, max_total)
+        self.loop = None
+
+    def acquire(self, host, port):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            with self._lock:
+                stale = [conn for idle in self._idle.values() for conn, _ in idle]
+                self._idle.clear()
+                self.evictions += len(stale)
+            for conn in stale:
+                self.discard(conn)
+            self.loop = loop
+        return super().acquire(host, port)
+
+    def is_healthy(self, conn):
+        reader, writer = conn
+        return not writer.is_closing() and not reader.at_eof()
+
+    def discard(self, conn):
+        reader, writer = conn
+        try:
+            writer.close()
+        except RuntimeError:
+            # its event loop is closed, so only the socket itself can still be shut down
+            try:
+                writer.get_extra_info('socket').shutdown(socket.SHUT_RDWR)
+            except (AttributeError, OSError):
+                pass
+
+class CacheEntry(object):
+    '''
+        A stored response and what is needed to tell whether it is still fresh
+
+        Args:
+            url         (str)       :   The url the response was fetched from
+            code        (int)       :   The status code
+            body        (bytes)     :   The body as received, after any Content-Encoding was undone
+            headers     (Headers)   :   The response headers
+            vary        (dict)      :   The request header values named by the Vary header, keyed by lowercase name
+            stored      (float)     :   The wall clock time the response was stored or last revalidated
+            lifetime    (float)     :   Seconds after stored that the response stays fresh
+    '''
+    def __init__(self, url, code, body, headers, vary, stored, lifetime):
+        self.url = url
+        self.code = code
+        self.body = body
+        self.headers = headers
+        self.vary = vary
+        self.stored = stored
+        self.lifetime = lifetime
+        self.size = len(body) + sum(len(name) + len(value) for name, value in headers.items())
+
+    def is_fresh(self, now):
+        return now - self.stored < self.lifetime
+
+    def matches(self, headers):
+        '''
+            Checks that a request asks for the same variant as the one stored
+
+            Args:
+                headers (dict)  :   The caller's request headers
+
+            Returns:
+                matches (bool)  :   True if every header named by Vary has the stored value
+        '''
+        headers = {name.lower(): value for name, value in (headers or {}).items()}
+        return all(headers.get(name) == value for name, value in self.vary.items())
+
+    def validators(self):
+        '''
+            Returns the conditional request headers that revalidate the stored response
+        '''
+        headers = {}
+        etag = self.headers.get('etag')
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        last_modified = self.headers.get('last-modified')
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def response(self):
+        return HTTPResponse(self.code, self.body, self.url, self.headers)
+
+    def to_json(self):
+        import base64
+        import json
+        # the body goes in as base64 so bytes that are not UTF-8 survive the round trip
+        return json.dumps({'url': self.url, 'code': self.code,
+                           'content': base64.b64encode(self.body).decode('ascii'),
+                           'headers': self.headers.items(), 'vary': self.vary,
+                           'stored': self.stored, 'lifetime': self.lifetime})
+
+    @classmethod
+    def from_json(cls, text):
+        import base64
+        import json
+        data = json.loads(text)
+        return cls(data['url'], data['code'], base64.b64decode(data['content']), Headers(data['headers']),
+                   data['vary'], data['stored'], data['lifetime'])
+
+class ResponseCache(object):
+    '''
+        Caches GET responses, honouring Cache-Control and Expires. A stale response
+        is revalidated with If-None-Match and If-Modified-Since so that a 304 reuses
+        the stored body. Once the stored responses pass max_bytes the least recently
+        used are evicted from memory. With a directory every response is also kept
+        on disk, where it outlives eviction and the process.
+
+        References:
+            - https://datatracker.ietf.org/doc/html/rfc9111
+
+        Args:
+            max_bytes   (int)   :   The most bytes of bodies and headers kept in memory
+            directory   (str)   :   A directory to also keep responses in, or None to keep them in memory only
+    '''
+    CACHEABLE = (200, 203, 300, 301, 308, 404, 410)
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.size = 0
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def cache_control(headers):
+        '''
+            Parses every Cache-Control header into {directive : argument}
+
+            Args:
+                headers (Headers or dict)   :   The headers to read
+
+            Returns:
+                directives  (dict)  :   Lowercase directive names, with '' for those without an argument
+        '''
+        if isinstance(headers, Headers):
+            values = headers.get_all('cache-control')
+        else:
+            values = [value for name, value in (headers or {}).items() if name.lower() == 'cache-control']
+        directives = {}
+        for value in values:
+            for part in value.split(','):
+                name, _, arg = part.strip().partition('=')
+                if name:
+                    directives[name.lower()] = arg.strip().strip('"')
+        return directives
+
+    def lifetime(self, headers, now):
+        '''
+            Works out how long a response stays fresh
+
+            Args:
+                headers (Headers)   :   The response headers
+                now     (float)     :   The wall clock time the response was received
+
+            Returns:
+                lifetime    (float) :   Seconds the response is fresh for, 0 if it must be revalidated
+                                        before every use, None if it must not be stored
+        '''
+        directives = self.cache_control(headers)
+        if 'no-store' in directives:
+            return None
+        if 'no-cache' in directives:
+            return 0.0
+        try:
+            age = float(headers.get('age', 0))
+        except ValueError:
+            age = 0.0
+        if 'max-age' in directives:
+            try:
+                return max(0.0, int(directives['max-age']) - age)
+            except ValueError:
+                return 0.0
+        expires = headers.get('expires')
+        if expires is not None:
+            # an Expires that does not parse means the response is already stale
+            from email.utils import parsedate_tz, mktime_tz
+            expires = parsedate_tz(expires)
+            if expires is None:
+                return 0.0
+            date = parsedate_tz(headers.get('date', ''))
+            date = mktime_tz(date) if date is not None else now
+            return max(0.0, mktime_tz(expires) - date - age)
+        return 0.0
+
+    def path(self, url):
+        import hashlib
+        return os.path.join(self.directory, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+    def lookup(self, url, headers=None):
+        '''
+            Returns the stored response for the url, if there is one for the same variant
+
+            Args:
+                url     (str)   :   The requested url
+                headers (dict)  :   The caller's request headers
+
+            Returns:
+                entry   (CacheEntry)    :   The stored response, fresh or not, or None
+        '''
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+        if entry is None and self.directory is not None:
+            try:
+                with open(self.path(url), encoding='utf-8') as f:
+                    entry = CacheEntry.from_json(f.read())
+            except (OSError, ValueError, KeyError):
+                return None
+            self._insert(entry)
+        if entry is None or not entry.matches(headers):
+            return None
+        return entry
+
+    def store(self, url, headers, response):
+        '''
+            Stores a response if its status and headers allow it
+
+            Args:
+                url         (str)           :   The requested url
+                headers     (dict)          :   The caller's request headers
+                response    (HTTPResponse)  :   The response from the server
+
+            Returns:
+                entry   (CacheEntry)    :   The stored response, or None if it was not stored
+        '''
+        if response.code not in self.CACHEABLE:
+            return None
+        now = time.time()
+        lifetime = self.lifetime(response.headers, now)
+        names = [name.strip().lower() for value in response.headers.get_all('vary') for name in value.split(',')]
+        if lifetime is None or '*' in names:
+            self.invalidate(url)
+            return None
+        if lifetime == 0 and 'etag' not in response.headers and 'last-modified' not in response.headers:
+            # it could never be used without fetching the whole body again
+            return None
+        request = {name.lower(): value for name, value in (headers or {}).items()}
+        vary = {name: request.get(name) for name in names if name}
+        entry = CacheEntry(url, response.code, bytes(response.content), response.headers, vary, now, lifetime)
+        if entry.size > self.max_bytes:
+            return None
+        self._insert(entry)
+        self.save(entry)
+        with self._lock:
+            self.stores += 1
+        return entry
+
+    def revalidated(self, entry, response):
+        '''
+            Refreshes a stored response from a 304 and returns it in place of the 304
+
+            Args:
+                entry       (CacheEntry)    :   The stored response that was revalidated
+                response    (HTTPResponse)  :   The 304 from the server
+
+            Returns:
+                response    (HTTPResponse)  :   The stored response with the updated headers
+        '''
+        updated = set(name.lower() for name in response.headers)
+        headers = Headers([(name, value) for name, value in entry.headers.items() if name.lower() not in updated])
+        for name, value in response.headers.items():
+            headers.add(name, value)
+        entry.headers = headers
+        entry.stored = time.time()
+        lifetime = self.lifetime(headers, entry.stored)
+        entry.lifetime = lifetime if lifetime is not None else 0.0
+        self.save(entry)
+        with self._lock:
+            self.revalidations += 1
+        return entry.response()
+
+    def fetch(self, url, headers, send):
+        '''
+            Answers a GET from the cache, revalidating or fetching it as needed
+
+            Args:
+                url     (str)       :   The requested url
+                headers (dict)      :   The caller's request headers
+                send    (callable)  :   Called with the request headers to send the request, returns an HTTPResponse
+
+            Returns:
+                response    (HTTPResponse)  :   The stored or fetched response
+        '''
+        entry = None
+        if 'no-cache' not in self.cache_control(headers):
+            entry = self.lookup(url, headers)
+        if entry is not None and entry.is_fresh(time.time()):
+            with self._lock:
+                self.hits += 1
+            return entry.response()
+        request = dict(headers or {})
+        if entry is not None:
+            request.update(entry.validators())
+        response = send(request)
+        if entry is not None and response.code == 304:
+            return self.revalidated(entry, response)
+        with self._lock:
+            self.misses += 1
+        self.store(url, headers, response)
+        return response
+
+    def _insert(self, entry):
+        with self._lock:
+            old = self._entries.pop(entry.url, None)
+            if old is not None:
+                self.size -= old.size
+            self._entries[entry.url] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.size
+                self.evictions += 1
+
+    def save(self, entry):
+        if self.directory is None:
+            return
+        path = self.path(entry.url)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(entry.to_json())
+        os.replace(path + '.tmp', path)
+
+    def invalidate(self, url):
+        '''
+            Drops the stored response for a url from memory and disk
+
+            Args:
+                url (str)   :   The url to forget
+        '''
+        with self._lock:
+            entry = self._entries.pop(url, None)
+            if entry is not None:
+                self.size -= entry.size
+        if self.directory is not None:
+            try:
+                os.remove(self.path(url))
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        '''
+            Drops every stored response from memory and disk
+        '''
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+        if self.directory is not None:
+            for name in os.listdir(self.directory):
+                if name.endswith('.json'):
+                    os.remove(os.path.join(self.directory, name))
+
+    def stats(self):
+        '''
+            Returns the cache counters
+
+            Returns:
+                stats   (dict)  :   The hits (fresh), revalidations (304), misses, stores, evictions,
+                                    the entries and bytes held in memory, and the hit rate, which
+                                    counts revalidations since they skip the body
+        '''
+        with self._lock:
+            lookups = self.hits + self.revalidations + self.misses
+            return {'hits': self.hits, 'revalidations': self.revalidations, 'misses': self.misses,
+                    'stores': self.stores, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'bytes': self.size,
+                    'hit_rate': (self.hits + self.revalidations) / lookups if lookups else 0.0}
+
+class TokenBucket(object):
+    '''
+        Allows rate events a second on average, in bursts of up to burst
+
+        Args:
+            rate    (float) :   Tokens added per second
+            burst   (float) :   The most tokens held
+    '''
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        '''
+            Returns the seconds until a token is available, 0 if one is now
+        '''
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+class HostState(object):
+    '''
+        What a HostScheduler knows about one host: its bucket, the requests in flight
+        and waiting, how long it is paused for, and its counters
+    '''
+    def __init__(self, rate, burst):
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.in_flight = 0
+        self.waiters = collections.deque()
+        self.paused_until = 0.0
+        self.backoff = 0.0
+        self.started = 0
+        self.throttled = 0
+        self.waited = 0.0
+        self.max_wait = 0.0
+
+    def delay(self, now, max_in_flight):
+        '''
+            Returns the seconds until the next waiting request may start, 0 if it may
+            start now, or None if it has to wait for a request to finish
+        '''
+        if max_in_flight is not None and self.in_flight >= max_in_flight:
+            return None
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.bucket is not None:
+            return self.bucket.wait_time(now)
+        return 0.0
+
+    def is_idle(self, now):
+        if self.in_flight or self.waiters or self.backoff or now < self.paused_until:
+            return False
+        if self.bucket is not None:
+            self.bucket.refill(now)
+            return self.bucket.tokens >= self.bucket.burst
+        return True
+
+class HostScheduler(object):
+    '''
+        Decides when each request may start. Every host has a token bucket and a cap
+        on requests in flight, and there may also be a cap across all hosts. Requests
+        to one host start in the order they arrived, and the hosts with requests
+        waiting take turns, so one busy host cannot starve the rest.
+
+        A 429 or 503 pauses its host for the Retry-After, or failing that for a
+        backoff that doubles with each one in a row, and halves the host's rate.
+        Every other response resets the backoff and wins back a tenth of the rate.
+
+        Args:
+            rate            (float) :   Requests a second to each host, or None for no limit
+            burst           (int)   :   Requests a host may start at once after being idle
+            max_in_flight   (int)   :   The most requests in flight to each host, or None for no limit
+            max_total       (int)   :   The most requests in flight across hosts, or None for no limit
+            backoff         (float) :   The first pause after a 429 or 503 without a Retry-After, in seconds
+            max_backoff     (float) :   The longest pause, Retry-After included
+    '''
+    THROTTLED = (429, 503)
+
+    def __init__(self, rate=None, burst=1, max_in_flight=None, max_total=None, backoff=1.0, max_backoff=60.0):
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.max_total = max_total
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.in_flight = 0
+        self.started = 0
+        self.throttled = 0
+        self.waited = 0.0
+        self.max_wait = 0.0
+        self._hosts = {}
+        self._ready = collections.deque()
+        self._sweep_at = 1024
+        self._cond = threading.Condition()
+
+    def acquire(self, host):
+        '''
+            Blocks until a request to the host may start
+
+            Args:
+                host    (str)   :   The host about to be requested
+        '''
+        started = time.monotonic()
+        with self._cond:
+            state = self._hosts.get(host)
+            if state is None:
+                if len(self._hosts) >= self._sweep_at:
+                    self.sweep(started)
+                state = self._hosts[host] = HostState(self.rate, self.burst)
+            ticket = [False]
+            state.waiters.append(ticket)
+            if len(state.waiters) == 1:
+                self._ready.append(host)
+            while True:
+                wait = self.dispatch(time.monotonic())
+                if ticket[0]:
+                    break
+                self._cond.wait(wait)
+            waited = time.monotonic() - started
+            state.waited += waited
+            state.max_wait = max(state.max_wait, waited)
+            self.waited += waited
+            self.max_wait = max(self.max_wait, waited)
+
+    def dispatch(self, now):
+        '''
+            Starts every waiting request that may start, one host at a time in turn.
+            Must be called with the lock held.
+
+            Returns:
+                wait    (float) :   The seconds until a paused or rate limited host may start
+                                    one, or None if the rest wait for requests to finish
+        '''
+        wait = None
+        progress = True
+        while progress:
+            progress = False
+            for host in list(self._ready):
+                if self.max_total is not None and self.in_flight >= self.max_total:
+                    return wait
+                state = self._hosts[host]
+                delay = state.delay(now, self.max_in_flight)
+                if delay == 0.0:
+                    state.waiters.popleft()[0] = True
+                    state.in_flight += 1
+                    state.started += 1
+                    if state.bucket is not None:
+                        state.bucket.take(now)
+                    self.in_flight += 1
+                    self.started += 1
+                    # to the back of the line, so the other hosts go first
+                    self._ready.remove(host)
+                    if state.waiters:
+                        self._ready.append(host)
+                    progress = True
+                    self._cond.notify_all()
+                elif delay is not None:
+                    wait = delay if wait is None else min(wait, delay)
+        return wait
+
+    def release(self, host, response=None):
+        '''
+            Marks a request to the host as finished and adapts to its response
+
+            Args:
+                host        (str)           :   The host that was requested
+                response    (HTTPResponse)  :   The response, or None if the request failed
+        '''
+        now = time.monotonic()
+        with self._cond:
+            state = self._hosts[host]
+            state.in_flight -= 1
+            self.in_flight -= 1
+            if response is not None and response.code in self.THROTTLED:
+                state.throttled += 1
+                self.throttled += 1
+                state.backoff = min(self.max_backoff, state.backoff * 2 if state.backoff else self.backoff)
+                pause = self.retry_after(response.headers)
+                pause = state.backoff if pause is None else min(self.max_backoff, pause)
+                state.paused_until = max(state.paused_until, now + pause)
+                if state.bucket is not None:
+                    state.bucket.rate = max(self.rate / 64, state.bucket.rate / 2)
+            elif response is not None:
+                state.backoff = 0.0
+                if state.bucket is not None:
+                    state.bucket.rate = min(self.rate, state.bucket.rate + self.rate / 10)
+            self._cond.notify_all()
+
+    @staticmethod
+    def retry_after(headers):
+        '''
+            Returns the seconds a Retry-After header asks to wait, or None if there is none
+
+            Args:
+                headers (Headers)   :   The response headers
+        '''
+        value = headers.get('retry-after')
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            from email.utils import parsedate_tz, mktime_tz
+            date = parsedate_tz(value)
+            return None if date is None else max(0.0, mktime_tz(date) - time.time())
+
+    def sweep(self, now):
+        '''
+            Forgets the hosts that are idle with a full bucket, so memory stays
+            bounded over a long run. Must be called with the lock held.
+        '''
+        for host in [host for host, state in self._hosts.items() if state.is_idle(now)]:
+            del self._hosts[host]
+        self._sweep_at = max(1024, 2 * len(self._hosts))
+
+    def stats(self):
+        '''
+            Returns the scheduler counters
+
+            Returns:
+                stats   (dict)  :   The requests in flight, queued, started and throttled, the total,
+                                    mean and max seconds spent waiting, and the same per known host
+                                    along with its current rate and the seconds it is paused for
+        '''
+        now = time.monotonic()
+        with self._cond:
+            hosts = {}
+            for host, state in self._hosts.items():
+                hosts[host] = {'in_flight': state.in_flight, 'queued': len(state.waiters),
+                               'started': state.started, 'throttled': state.throttled,
+                               'wait_mean': state.waited / state.started if state.started else 0.0,
+                               'wait_max': state.max_wait,
+                               'rate': state.bucket.rate if state.bucket is not None else None,
+                               'paused': max(0.0, state.paused_until - now)}
+            return {'in_flight': self.in_flight, 'queued': sum(host['queued'] for host in hosts.values()),
+                    'started': self.started, 'throttled': self.throttled, 'wait_total': self.waited,
+                    'wait_mean': self.waited / self.started if self.started else 0.0,
+                    'wait_max': self.max_wait, 'hosts': hosts}
+
+class Retry(object):
+    '''
+        When and how soon to send a failed request again. A request is retried when
+        it fails, or gets one of statuses, and either the request was not sent yet or
+        its method is idempotent and its body can be sent again. The wait doubles with
+        each attempt up to max_backoff, with full jitter, and is at least the response's
+        Retry-After. A failure on a pooled connection the server had closed, before any
+        response arrived, is retried once at once and without spending the budget, even
+        when max_attempts is 1.
+
+        The budget keeps retries from piling onto a struggling server: each request adds
+        budget to a balance capped at reserve, and each retry takes one from it.
+
+        References:
+            - https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+            - https://datatracker.ietf.org/doc/html/rfc9110#section-9.2.2
+
+        Args:
+            max_attempts    (int)   :   The most times a request is sent, 1 to never retry
+            backoff         (float) :   The wait before the first retry, in seconds
+            max_backoff     (float) :   The longest wait, Retry-After included
+            jitter          (bool)  :   Whether to wait a random time up to the backoff rather than all of it
+            budget          (float) :   The retries each request earns
+            reserve         (float) :   The most retries that can be saved up
+            statuses        (tuple) :   The status codes to retry
+            methods         (tuple) :   The methods that may be retried once sent
+    '''
+    IDEMPOTENT = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE')
+
+    def __init__(self, max_attempts=3, backoff=0.1, max_backoff=10.0, jitter=True, budget=0.2, reserve=10.0,
+                 statuses=(502, 503, 504), methods=IDEMPOTENT):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.budget = budget
+        self.reserve = reserve
+        self.statuses = statuses
+        self.methods = methods
+        self.balance = reserve
+        self.retries = 0
+        self.exhausted = 0
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        '''
+            Adds a new request's share to the budget
+        '''
+        with self._lock:
+            self.balance = min(self.reserve, self.balance + self.budget)
+
+    def withdraw(self):
+        '''
+            Takes one retry from the budget
+
+            Returns:
+                allowed (bool)  :   False if the budget is spent
+        '''
+        with self._lock:
+            if self.balance < 1:
+                self.exhausted += 1
+                return False
+            self.balance -= 1
+            self.retries += 1
+            return True
+
+    def delay(self, method, attempt, response=None, error=None, replayable=True):
+        '''
+            Decides whether to retry a request
+
+            Args:
+                method      (str)           :   The method of the request
+                attempt     (int)           :   The attempts made so far, from 1
+                response    (HTTPResponse)  :   The response, its error set if the request failed
+                error       (RequestTimeout)    :   The timeout raised instead of a response
+                replayable  (bool)          :   Whether the body can be sent again
+
+            Returns:
+                delay   (float) :   The seconds to wait before retrying, or None not to retry
+        '''
+        if attempt >= self.max_attempts and attempt > 1:
+            return None
+        retry_after = None
+        stale = False
+        if error is not None:
+            if isinstance(error, DeadlineExceeded):
+                return None
+            sent = not isinstance(error, ConnectTimeout)
+        elif response.error is not None:
+            timings = response.timings
+            sent = timings is not None and timings.sent_bytes > 0
+            stale = timings is not None and timings.reused and timings.received_bytes == 0
+        elif response.code in self.statuses:
+            sent = True
+            retry_after = HostScheduler.retry_after(response.headers)
+        else:
+            return None
+        if sent and (method not in self.methods or not replayable):
+            return None
+        if stale:
+            return 0.0
+        if attempt >= self.max_attempts or not self.withdraw():
+            return None
+        backoff = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        if self.jitter:
+            import random
+            backoff = random.uniform(0, backoff)
+        if retry_after is not None:
+            backoff = max(backoff, min(self.max_backoff, retry_after))
+        return backoff
+
+    def stats(self):
+        '''
+            Returns the retry counters
+
+            Returns:
+                stats   (dict)  :   The retries made, the retries refused for lack of budget and the budget left
+        '''
+        with self._lock:
+            return {'retries': self.retries, 'exhausted': self.exhausted, 'balance': self.balance}
+
+class RequestBuilder(object):
+    '''
+        Builds requests as bytes. The Host, User-Agent, Connection and Accept-Encoding
+        lines only depend on the method and the origin, so they are encoded once and cached.
+
+        Args:
+            keep_alive      (bool)  :   Whether to ask the server to keep the connection open
+            user_agent      (str)   :   The User-Agent to send
+            max_cached      (int)   :   The most header prefixes kept before the cache is cleared
+            accept_encoding (str)   :   The Accept-Encoding to send, or None to not send one
+    '''
+    USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.116 Safari/537.36'
+    DEFAULTS = ('host', 'user-agent', 'connection', 'accept-encoding')
+    NAMES = {'host': 'Host', 'user-agent': 'User-Agent', 'connection': 'Connection', 'accept-encoding': 'Accept-Encoding'}
+
+    def __init__(self, keep_alive=True, user_agent=USER_AGENT, max_cached=1024, accept_encoding=None):
+        self.keep_alive = keep_alive
+        self.user_agent = user_agent
+        self.max_cached = max_cached
+        self.accept_encoding = accept_encoding
+        self._prefixes = {}
+
+    def prefix(self, method, host, port, skip=()):
+        '''
+            Returns the encoded default header lines for an origin
+
+            Args:
+                method  (str)   :   The method of the request
+                host    (str)   :   The host of the origin
+                port    (int)   :   The port of the origin
+                skip    (tuple) :   Lowercase names of default headers the caller replaces
+
+            Returns:
+                prefix  (bytes) :   The default header lines, each ending in CRLF
+        '''
+        key = (method, host, port, skip)
+        prefix = self._prefixes.get(key)
+        if prefix is None:
+            defaults = {
+                'host': host if port == 80 else f'{host}:{port}',
+                'user-agent': self.user_agent,
+                'connection': 'keep-alive' if self.keep_alive else 'close',
+                'accept-encoding': self.accept_encoding,
+            }
+            prefix = ''.join(f'{self.NAMES[name]}: {defaults[name]}\r\n' for name in self.DEFAULTS
+                             if name not in skip and defaults[name] is not None).encode('iso-8859-1')
+            if len(self._prefixes) >= self.max_cached:
+                self._prefixes.clear()
+            self._prefixes[key] = prefix
+        return prefix
+
+    def build(self, method, target, host, port, headers=None, body=None, content_type=None):
+        '''
+            Builds a request
+
+            Args:
+                method          (str)   :   The method of the request
+                target          (str)   :   The path and query of the request
+                host            (str)   :   The host of the origin
+                port            (int)   :   The port of the origin
+                headers         (dict)  :   Extra headers, these replace the default ones of the same name
+                body            (bytes) :   The body, or None for a request without one
+                content_type    (str)   :   The Content-Type of the body
+
+            Returns:
+                request (list)  :   The header bytes, followed by the body bytes if there is a body
+        '''
+        extra = []
+        skip = ()
+        if headers:
+            extra = list(headers.items())
+            skip = tuple(name.lower() for name, _ in extra if name.lower() in self.DEFAULTS)
+        names = [name.lower() for name, _ in extra]
+
+        head = [method.encode('ascii'), b' ', target.encode('utf-8'), b' HTTP/1.1\r\n',
+                self.prefix(method, host, port, skip)]
+        for name, value in extra:
+            head.append(f'{name}: {value}\r\n'.encode('iso-8859-1'))
+        if body is not None:
+            if content_type is not None and 'content-type' not in names:
+                head.append(b'Content-Type: ' + content_type.encode('iso-8859-1') + b'\r\n')
+            length = self.body_length(body)
+            if length is not None and 'content-length' not in names:
+                head.append(b'Content-Length: %d\r\n' % length)
+            elif length is None and 'transfer-encoding' not in names and 'content-length' not in names:
+                head.append(b'Transfer-Encoding: chunked\r\n')
+        head.append(b'\r\n')
+
+        if body is None or (isinstance(body, (bytes, bytearray)) and not body):
+            return [b''.join(head)]
+        return [b''.join(head), body]
+
+    def body_length(self, body):
+        '''
+            Works out the size of a body without reading it
+
+            Args:
+                body    (bytes, file or iterable)   :   The body of the request
+
+            Returns:
+                length  (int)   :   The size in bytes, or None if it is only known once the body is sent
+        '''
+        if isinstance(body, (bytes, bytearray)):
+            return len(body)
+        if isinstance(body, memoryview):
+            return body.nbytes
+        if not hasattr(body, 'read'):
+            return None
+        try:
+            stat = os.fstat(body.fileno())
+            if S_ISREG(stat.st_mode):
+                return stat.st_size - body.tell()
+        except (AttributeError, OSError, ValueError):
+            pass
+        try:
+            if body.seekable():
+                position = body.tell()
+                end = body.seek(0, os.SEEK_END)
+                body.seek(position)
+                return end - position
+        except (AttributeError, OSError, ValueError):
+            pass
+        return None
+
+class BaseHTTPClient(object):
+    '''
+        The parts of a client that do not touch sockets, shared by the blocking
+        HTTPClient and the asyncio AsyncHTTPClient
+    '''
+    ACCEPT_ENCODING = 'gzip, deflate'
+    REDIRECTS = (301, 302, 303, 307, 308)
+
+    def decoder(self, parser):
+        '''
+            Returns a ContentDecoder for the response, or None if it is not compressed
+            or the client does not decompress
+
+            Args:
+                parser  (ResponseParser)    :   The parser for the response, past its headers
+        '''
+        if not self.decompress:
+            return None
+        return ContentDecoder.for_encoding(parser.field('content-encoding'))
+
+    def decode(self, decoder, pieces):
+        '''
+            Decompresses body pieces as they are produced
+
+            Args:
+                decoder (ContentDecoder)    :   The decoder for the response
+                pieces  (iterable)          :   The compressed body pieces
+        '''
+        for piece in pieces:
+            yield from decoder.decompress(piece)
+        rest = decoder.flush()
+        if rest:
+            yield rest
+
+    def record_sizes(self, response, parser, body):
+        '''
+            Records the body size on the wire and the size after decompression on the response
+
+            Args:
+                response    (HTTPResponse)      :   The response to record the sizes on
+                parser      (ResponseParser)    :   The parser that read the response
+                body        (bytearray)         :   The decoded body
+        '''
+        response.raw_bytes = parser.body_bytes
+        response.decoded_bytes = len(body)
+        return response
+
+    def parse_url(self, url, args=None):
+        '''
+            Parses the URL into a dictionary format
+
+            References:
+                - https://www.urlencoder.io/python/
+
+            Args:
+                url    (str)   :   The url to be parsed
+            
+            Returns:
+                options    (dict)   :   The parsed url with {url_option : value}
+        '''
+
+        parsed_url = {}
+
+        u = urlparse(url)
+
+        if u.path:
+            target = u.path
+        else:
+            target = '/'
+        parsed_url['target'] = target
+
+        if u.hostname:
+            host = u.hostname
+        else:
+            host = u.path
+        parsed_url['host'] = host
+
+        if u.port:
+            port = u.port
+        else:
+            port = 80  # arbitrary port
+        parsed_url['port'] = port
+
+        if args:
+            parsed_url['query'] = urlencode(args)
+        else:
+            parsed_url['query'] = u.query
+
+
+        return parsed_url
+    
+    def build_request(self, options, command="GET", args=None, headers=None, body=None):
+        '''
+            Builds the request to be sent to the server
+            References:
+                - https://stackoverflow.com/questions/17667903/python-socket-receive-large-amount-of-data
+
+            Args:
+                options    (dict)   :   The parsed URL options
+                command    (str)    :   The command to be sent to the server
+                args       (dict)   :   The form fields to POST, instead of the query in options
+                headers    (dict)   :   Extra request headers, these replace the default ones of the same name
+                body       (bytes, str, file or iterable)   :   The body, a POST without one sends its form fields
+            
+            Returns:
+                request    (list)   :   The header bytes and the body, ready for HTTPClient.sendall
+        '''
+        target = options['target']
+        content_type = None
+        if body is None and command == 'POST':
+            body = urlencode(args) if args else options['query']
+            content_type = 'application/x-www-form-urlencoded'
+        elif options['query']:
+            target += '?' + options['query']
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+
+        return self.builder.build(command, target, options['host'], options['port'], headers, body, content_type)
+
+class HTTPClient(BaseHTTPClient):
+    '''
+        A blocking HTTP client. Sockets are passed from call to call rather than
+        kept on the instance, so one client and its pool can be shared by threads.
+        Every response carries its Timings, and add_hook lets callers observe requests.
+    '''
+    HOOKS = ('request', 'connect', 'headers', 'done', 'error')
+    # the most body bytes allocated before they arrive, on the word of a Content-Length
+    PREALLOCATE = 4 * 1024 * 1024
+
+    def __init__(self, pool=None, keep_alive=True, timeout=None, resolver=None, decompress=True, cache=None,
+                 max_redirects=10, scheduler=None, retry=None):
+        '''
+            Args:
+                pool        (ConnectionPool)    :   The pool to reuse sockets from, a new one is made if not given
+                keep_alive  (bool)              :   Whether to ask the server to keep the connection open
+                timeout     (Timeout or float)  :   The default time limits of a request
+                resolver    (Resolver)          :   The DNS cache to connect through, a new one is made if not given
+                decompress  (bool)              :   Whether to ask for gzip and deflate and decompress the body
+                cache       (ResponseCache)     :   The cache to answer GETs from, or None to always go to the network
+                max_redirects   (int)           :   The most redirects followed per request, 0 to return them as they are
+                scheduler   (HostScheduler)     :   Decides when each request may start, or None to start them at once
+                retry       (Retry)             :   When to send a failed request again, only on a stale pooled
+                                                    connection if None
+        '''
+        self.pool = pool if pool is not None else ConnectionPool()
+        self.cache = cache
+        self.max_redirects = max_redirects
+        self.scheduler = scheduler
+        self.retry = retry if retry is not None else Retry(max_attempts=1)
+        self.decompress = decompress
+        self.builder = RequestBuilder(keep_alive, accept_encoding=self.ACCEPT_ENCODING if decompress else None)
+        self.resolver = resolver if resolver is not None else Resolver()
+        self.keep_alive = keep_alive
+        self.timeout = Timeout.coerce(timeout)
+        self.timeouts = {'connect': 0, 'read': 0, 'total': 0}
+        self.hooks = {event: [] for event in self.HOOKS}
+        self._lock = threading.Lock()
+
+    def count_timeout(self, phase):
+        with self._lock:
+            self.timeouts[phase] += 1
+
+    def add_hook(self, event, callback):
+        '''
+            Registers a function to be called at a point in the life of every request
+
+                'request'   :   callback(method, url), before connecting
+                'connect'   :   callback(method, url, timings), once connected or given a pooled socket
+                'headers'   :   callback(method, url, code, headers), once the response headers are parsed
+                'done'      :   callback(method, url, response), once the body is received, response.timings
+                                is then complete
+                'error'     :   callback(method, url, error), when the request fails
+
+            Args:
+                event       (str)       :   One of HOOKS
+                callback    (function)  :   The function to call
+        '''
+        if event not in self.hooks:
+            raise ValueError(f'unknown hook {event!r}, expected one of {self.HOOKS}')
+        self.hooks[event].append(callback)
+
+    def emit(self, event, *args):
+        for callback in self.hooks[event]:
+            callback(*args)
+
+    def deadline(self, timeout=None):
+        '''
+            Starts the clock on a request
+
+            Args:
+                timeout (Timeout or float)  :   The time limits of the request, the client default if None
+
+            Returns:
+                deadline    (Deadline)  :   The deadline to pass to the socket operations
+        '''
+        timeout = self.timeout if timeout is None else Timeout.coerce(timeout)
+        return Deadline(timeout, self.count_timeout)
+
+    def connect(self, host, port, deadline=None):
+        '''
+            Connect to the specified host and port using the socket object.
+            An idle pooled socket to the same origin is reused when one is available.
+
+            Args:
+                host        (str)       :   The host specified in the request
+                port        (int)       :   The port specified in the request
+                deadline    (Deadline)  :   The time limits of the request
+
+            Returns:
+                sock    (socket)    :   The connected socket
+        '''
+        if deadline is None:
+            deadline = self.deadline()
+        sock = self.pool.acquire(host, port) if self.keep_alive else None
+        if sock is None:
+            sock = deadline.connect(self.resolver, host, port)
+        else:
+            deadline.timings.reused = True
+            deadline.timings.lap()
+        return sock
 
-    def connect(self, host, port):
+    def release(self, host, port, keep_alive, sock):
         '''
-            Connect to the specified host and port using the socket object 
+            Returns the socket to the pool if the response allows it, otherwise closes it
 
             Args:
-                host    (str)   :   The host specified in the request
-                port    (int)   :   The port specified in the request
+                host        (str)       :   The host specified in the request
+                port        (int)       :   The port specified in the request
+                keep_alive  (bool)      :   Whether the response left the connection reusable
+                sock        (socket)    :   The socket to release
         '''
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((host, port))
-        return None
+        if self.keep_alive and keep_alive and sock.fileno() >= 0:
+            self.pool.release(host, port, sock)
+        else:
+            sock.close()
 
     def get_code(self, data):
         '''
@@ -79,100 +2526,131 @@ class HTTPClient(object):
 
     def parse_header(self, header):
         '''
-            Parses the header into a dictionary format
+            Parses the header into a case-insensitive map
 
             Args:
                 header    (str)   :   The header to be parsed
             
             Returns
-                header_dict    (dict)  :   The parsed header with {option : value}
+                headers    (Headers)  :   The parsed header with {option : value}
         '''
-        header_dict = {}
-        for line in header.split('\r\n'):
-            if ':' in line:
-                key, value = line.split(': ')
-                header_dict[key] = value
-
-        return header_dict
+        return Headers.parse(header.encode('iso-8859-1'))
 
     def get_body(self, data):
         return data.split('\r\n\r\n')[1]
     
-    def build_request(self, options, command="GET", args=None):
+    def sendall(self, sock, data, deadline=None):
         '''
-            Builds the request to be sent to the server
-            References:
-                - https://stackoverflow.com/questions/17667903/python-socket-receive-large-amount-of-data
+            Sends the data to the server
 
             Args:
-                options    (dict)   :   The parsed URL options
-                command    (str)    :   The command to be sent to the server
-            
-            Returns:
-                request    (str)    :   The final request (header + body) to be sent to the server
-        
+                sock        (socket)    :   The socket to send on
+                data        (list)      :   The bytes to be sent to the server, as returned by build_request
+                deadline    (Deadline)  :   The time limits of the request
         '''
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = [data]
+        if deadline is None:
+            deadline = self.deadline()
+        if not data:
+            return
+        head, body = data[0], data[1] if len(data) > 1 else None
+        if body is None or isinstance(body, (bytes, bytearray, memoryview)):
+            deadline.sendmsg(sock, data)
+            return
+        deadline.sendmsg(sock, [head])
+        self.send_body(sock, body, deadline)
 
-        # Set the date, target url and host from the parsed url
-        date = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-        target = options['target']
-        host = options['host']
+    def send_body(self, sock, body, deadline):
+        '''
+            Sends a file or iterable body. A file of known size goes through
+            socket.sendfile, anything else is sent with chunked transfer-encoding.
 
-        # Build the request : common to both GET and POST 
-        header = (
-            f'{command} {target} HTTP/1.1\r\n'
-            f'Date: {date}\r\n'
-            f'Host: {host}\r\n'
-            f'User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.116 Safari/537.36\r\n'
-        )
-
-        # Return the header if it is a GET request
-        if command == 'GET':
-            header += f'Connection: close\r\n'
-            header += f'\r\n'
-            return header
-        
-        # Else, add the content-length and content-type headers
-        if command == 'POST':
-            if args:
-                encode_data = json.dumps(args).encode('utf-8')
-                length = len(encode_data) 
-                body = encode_data.decode('utf-8')
-            else:
-                length = len(options['query']) 
-                body = options['query']
+            Args:
+                sock        (socket)                :   The socket to send on
+                body        (file or iterable)      :   The body of the request
+                deadline    (Deadline)              :   The time limits of the request
+        '''
+        length = self.builder.body_length(body)
+        if length is not None:
+            deadline.sendfile(sock, body, length)
+            return
+        chunks = iter(lambda: body.read(65536), b'') if hasattr(body, 'read') else body
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if chunk:
+                deadline.sendmsg(sock, [b'%x\r\n' % len(chunk), chunk, b'\r\n'])
+        deadline.sendmsg(sock, [b'0\r\n\r\n'])
 
+    def close(self):
+        '''
+            Closes every idle socket in the pool
+        '''
+        self.pool.close()
+
+    def recv_head(self, sock, parser, buffer=None, deadline=None):
+        '''
+            Reads from the socket until the status line and headers are parsed
 
-            header += (
-                f'Content-Type: application/x-www-form-urlencoded\r\n'
-                f'Content-Length: {length}\r\n'
-                f'Connection: keep-alive\r\n'
-                
-            )
+            Args:
+                sock        (socket)            :   The socket object
+                parser      (ResponseParser)    :   The parser for the response
+                buffer      (ReceiveBuffer)     :   The buffer to read into
+                deadline    (Deadline)          :   The time limits of the request
 
-            header += '\r\n'
-            print(header + body)
-            return header + body
-    
-    def sendall(self, data):
+            Returns:
+                pieces  (list)  :   The body pieces that arrived along with the headers,
+                                    they are views of buffer
         '''
-            Sends the data to the server
+        if buffer is None:
+            buffer = ReceiveBuffer()
+        pieces = []
+        while parser.state == ResponseParser.STATUS or parser.state == ResponseParser.HEADERS:
+            part = buffer.recv(sock, deadline)
+            if not part:
+                parser.feed_eof()
+            pieces = parser.feed(part)
+        if deadline is not None:
+            deadline.timings.received_headers(parser)
+        return pieces
+
+    def iter_body(self, sock, parser, pieces=(), buffer=None, deadline=None):
+        '''
+            Yields the decoded body pieces as they arrive, until the response is done.
+            Each piece is a view of the receive buffer and is only valid until the next one.
 
             Args:
-                data    (str)   :   The data to be sent to the server
+                sock    (socket)            :   The socket object
+                parser  (ResponseParser)    :   The parser for the response, past its headers
+                pieces  (list)              :   Body pieces already received with the headers
+                buffer  (ReceiveBuffer)     :   The buffer to read into
+                deadline    (Deadline)      :   The time limits of the request
         '''
-        if data:
-            self.socket.sendall(data.encode('utf-8'))
-        else:
-            self.socket.shutdown(socket.SHUT_WR)
-        
-    def close(self):
-        self.socket.close()
+        if buffer is None:
+            buffer = ReceiveBuffer()
+        for piece in pieces:
+            yield piece
+        while not parser.done:
+            part = buffer.recv(sock, deadline)
+            if not part:
+                parser.feed_eof()
+                break
+            for piece in parser.feed(part):
+                yield piece
+        if deadline is not None:
+            deadline.timings.finish()
 
     # read everything from the socket
-    def recvall(self, sock):
+    def recvall(self, sock, method='GET', deadline=None):
         '''
-            Reads everything from the server socket. If a Content-Length header is present, read until the Content-Length is reached.
+            Reads one response from the server socket. The response is fed into a
+            ResponseParser so reading stops as soon as the body framed by Content-Length
+            or chunked encoding is complete, or when the server closes the connection
+            if there is no framing. A body with a known Content-Length is read straight
+            into a buffer allocated once at its exact size, up to PREALLOCATE bytes. Past
+            that the Content-Length is not trusted up front and the buffer doubles as the
+            body arrives, so a server cannot make the client allocate what it never sends.
 
             References
                 - https://stackoverflow.com/questions/4824451/detect-end-of-http-request-body/4824738
@@ -181,122 +2659,276 @@ class HTTPClient(object):
                 - http://stupidpythonideas.blogspot.com/2013/05/sockets-are-byte-streams-not-message.html
             
             Args:
-                sock    (socket)    :   The socket object 
+                sock        (socket)    :   The socket object 
+                method      (str)       :   The method of the request
+                deadline    (Deadline)  :   The time limits of the request
 
             Returns:
-                data    (str)   :   The decoded data received from the server
+                parser  (ResponseParser)    :   The parsed status line and headers
+                body    (bytearray)         :   The body received from the server
         '''
-        buffer = bytearray()
-        done = False
-        while not done:
-            part = sock.recv(1024)
-            # parse the header 
-
-            if (part):
-                buffer.extend(part)
-                # if the part ends in \r\n\r\n, then it is the header
-                if b'\r\n\r\n' in part:
-                    header = self.get_headers(part.decode('utf-8'))
-                    result = self.parse_header(header)
-                    
-                    # If the header has a Content-Length, then we need to read that many bytes
-                    if 'Content-Length' in result.keys():
-                        content_length = int(result['Content-Length'])
-                        if len(buffer) >= content_length:
-                            done = True
+        if deadline is None:
+            deadline = self.deadline()
+        parser = ResponseParser(method)
+        buffer = ReceiveBuffer()
+        pieces = self.recv_head(sock, parser, buffer, deadline)
+        decoder = self.decoder(parser)
 
-            else:
-                # if buffer matches content length, we are done
-                self.close()
-                done = True 
-        
-        return buffer.decode('utf-8')
-    
-    def parse_url(self, url, args=None):
-        '''
-            Parses the URL into a dictionary format
+        if parser.framing != 'length' or decoder is not None:
+            body = bytearray()
+            pieces = self.iter_body(sock, parser, pieces, buffer, deadline)
+            if decoder is not None:
+                pieces = self.decode(decoder, pieces)
+            for piece in pieces:
+                body.extend(piece)
+            return parser, body
 
-            References:
-                - https://www.urlencoder.io/python/
+        received = sum(len(piece) for piece in pieces)
+        total = received + parser.remaining
+        body = bytearray(min(total, max(received, self.PREALLOCATE)))
+        view = memoryview(body)
+        offset = 0
+        for piece in pieces:
+            view[offset:offset + len(piece)] = piece
+            offset += len(piece)
+        while not parser.done:
+            if offset == len(body):
+                view.release()
+                body.extend(bytes(min(total, len(body) * 2) - len(body)))
+                view = memoryview(body)
+            size = deadline.recv_into(sock, view[offset:])
+            if not size:
+                parser.feed_eof()
+            parser.advance(size)
+            offset += size
+        view.release()
+        deadline.timings.finish()
+        return parser, body
+
+    def receive(self, sock, host, port, method='GET', stream=False, deadline=None):
+        '''
+            Reads the response to the request just sent on the socket
 
             Args:
-                url    (str)   :   The url to be parsed
-            
+                sock    (socket)    :   The socket the request was sent on
+                host    (str)   :   The host specified in the request
+                port    (int)   :   The port specified in the request
+                method  (str)   :   The method of the request
+                stream  (bool)  :   Whether to return a StreamingHTTPResponse instead of reading the whole body
+                deadline    (Deadline)  :   The time limits of the request
+
             Returns:
-                options    (dict)   :   The parsed url with {url_option : value}
+                response    (HTTPResponse)  :   The response from the server
         '''
+        if not stream:
+            parser, body = self.recvall(sock, method, deadline)
+            self.release(host, port, parser.keep_alive, sock)
+            response = HTTPResponse(parser.code, body, headers=parser.take_headers())
+            response.raw_bytes = parser.body_bytes
+            response.decoded_bytes = len(body)
+            return response
 
-        parsed_url = {}
+        parser = ResponseParser(method)
+        buffer = ReceiveBuffer()
+        pieces = self.iter_body(sock, parser, self.recv_head(sock, parser, buffer, deadline), buffer, deadline)
+        decoder = self.decoder(parser)
+        if decoder is not None:
+            pieces = self.decode(decoder, pieces)
+        # the socket now belongs to the response until its body is consumed
+        return StreamingHTTPResponse(parser, pieces,
+                                     lambda keep_alive: self.release(host, port, keep_alive, sock))
 
-        u = urlparse(url)
+    def request(self, method, url, body=None, headers=None, stream=False, timeout=None, args=None):
+        '''
+            Sends a request to the server, following redirects up to max_redirects.
+            The Location is resolved against the current url. 301 and 302 turn a POST
+            into a GET and 303 turns anything but a HEAD into a GET, while 307 and 308
+            resend the same method and body, unless the body was a file or iterable
+            that cannot be sent twice. Credentials are not sent to another origin, and
+            a redirect to anything but http is returned rather than followed.
+            Hops to the same origin reuse the pooled keep-alive connection. With a
+            scheduler each hop waits for its host's turn, and the host counts as busy
+            until the response has arrived, or its headers if it is streamed.
 
-        if u.path:
-            target = u.path
-        else:
-            target = '/'
-        parsed_url['target'] = target
+            References:
+                - https://datatracker.ietf.org/doc/html/rfc9110#section-15.4
 
-        if u.hostname:
-            host = u.hostname
-        else:
-            host = u.path
-        parsed_url['host'] = host
+            Args:
+                method  (str)   :   The method of the request
+                url     (str)   :   The requested url
+                body    (bytes, str, file or iterable)  :   The body to send. A file or bytes is sent with
+                                                            a Content-Length, anything else is sent chunked
+                headers (dict)  :   Extra request headers
+                stream  (bool)  :   Whether to return the body lazily as a StreamingHTTPResponse
+                timeout (Timeout or float)  :   The time limits of each hop, the client default if None
+                args    (dict)  :   Form fields, sent as the body of a POST without one
 
-        if u.port:
-            port = u.port
-        else:
-            port = 80  # arbitrary port
-        parsed_url['port'] = port
+            Returns:
+                response    (HTTPResponse)  :   The final response, with the earlier hops in its redirects
+                                                and the time each hop took in their elapsed
+        '''
+        redirects = []
+        while True:
+            started = time.monotonic()
+            response = self.exchange(method, url, body, headers, stream, timeout, args)
+            response.elapsed = time.monotonic() - started
+            response.url = url
+            if response.code not in self.REDIRECTS or len(redirects) >= self.max_redirects:
+                break
+            location = response.headers.get('location')
+            if location is None:
+                break
+            target = urljoin(url, location)
+            if urlparse(target).scheme != 'http':
+                # only plain HTTP is spoken here, an https Location is left to the caller
+                # rather than followed unencrypted
+                break
+            if response.code in (307, 308):
+                if body is not None and not isinstance(body, (bytes, bytearray, memoryview, str)):
+                    break
+            elif method != 'HEAD' and (response.code == 303 or method == 'POST'):
+                method, body, args = 'GET', None, None
+                if headers:
+                    headers = {name: value for name, value in headers.items()
+                               if name.lower() not in ('content-type', 'content-length', 'transfer-encoding')}
+            if stream:
+                # read the redirect body so its connection can be reused
+                response.body
+            if headers and self.origin(target) != self.origin(url):
+                headers = {name: value for name, value in headers.items()
+                           if name.lower() not in ('authorization', 'cookie', 'proxy-authorization')}
+            redirects.append(response)
+            url = target
+        response.redirects = redirects
+        return response
 
-        if args:
-            parsed_url['query'] = urlencode(args)
-        else:
-            parsed_url['query'] = u.query
+    def exchange(self, method, url, body=None, headers=None, stream=False, timeout=None, args=None):
+        '''
+            Sends one request, waiting for the scheduler and retrying as the retry policy allows
 
+            Args:
+                method  (str)   :   The method of the request
+                url     (str)   :   The requested url
+                body    (bytes, str, file or iterable)  :   The body to send
+                headers (dict)  :   Extra request headers
+                stream  (bool)  :   Whether to return the body lazily as a StreamingHTTPResponse
+                timeout (Timeout or float)  :   The time limits of each attempt, the client default if None
+                args    (dict)  :   Form fields, sent as the body of a POST without one
 
-        return parsed_url
-    
-    def GET(self, url, args=None):
+            Returns:
+                response    (HTTPResponse)  :   The response to the last attempt, with the number made in attempts
         '''
-            Sends a GET request to the server
-            
+        host = self.parse_url(url)['host']
+        replayable = body is None or isinstance(body, (bytes, bytearray, memoryview, str))
+        self.retry.deposit()
+        attempt = 0
+        while True:
+            attempt += 1
+            response = error = None
+            if self.scheduler is not None:
+                self.scheduler.acquire(host)
+            try:
+                response = self.send(method, url, body, headers, stream, timeout, args)
+            except RequestTimeout as e:
+                error = e
+            finally:
+                if self.scheduler is not None:
+                    self.scheduler.release(host, response if response is not None and response.error is None else None)
+            delay = self.retry.delay(method, attempt, response, error, replayable)
+            if delay is None:
+                if error is not None:
+                    raise error
+                response.attempts = attempt
+                return response
+            if stream and response is not None and response.error is None:
+                response.close()
+            time.sleep(delay)
+
+    def origin(self, url):
+        options = self.parse_url(url)
+        return (urlparse(url).scheme, options['host'], options['port'])
+
+    def send(self, method, url, body=None, headers=None, stream=False, timeout=None, args=None):
+        '''
+            Sends one request to the server, without following redirects
+
             Args:
-                url    (str)   :   The requested url
-            
+                method  (str)   :   The method of the request
+                url     (str)   :   The requested url
+                body    (bytes, str, file or iterable)  :   The body to send. A file or bytes is sent with
+                                                            a Content-Length, anything else is sent chunked
+                headers (dict)  :   Extra request headers
+                stream  (bool)  :   Whether to return the body lazily as a StreamingHTTPResponse
+                timeout (Timeout or float)  :   The time limits of the request, the client default if None
+                args    (dict)  :   Form fields, sent as the body of a POST without one
+
             Returns:
-                response    (str)   :   The response from the server
+                response    (HTTPResponse)  :   The response from the server
         '''
         code = 500 # internal server error
-        data = ''
-        
-        options = self.parse_url(url)
+        options = self.parse_url(url, args)
         host = options['host']
         port = options['port']
+        sock = None
+        deadline = self.deadline(timeout)
+        timings = deadline.timings
+        self.emit('request', method, url)
 
         try:
             # Connect to server and send data
-            print('> Connecting to server...')
-            self.connect(host, port)
+            sock = self.connect(host, port, deadline)
+            self.emit('connect', method, url, timings)
 
             # Send a request in bytes 
-            print('> Requesting data...')
-            request = self.build_request(options, 'GET')
-            self.sendall(request)
+            request = self.build_request(options, method, headers=headers, body=body)
+            self.sendall(sock, request, deadline)
+
+            if self.hooks['headers']:
+                timings.on_headers = lambda code, headers: self.emit('headers', method, url, code, headers)
+            response = self.receive(sock, host, port, method, stream, deadline)
+            response.timings = timings
+            if timings.total is not None:
+                self.emit('done', method, url, response)
+            else:
+                # a streamed body is done once the caller has read it
+                timings.on_done = lambda: self.emit('done', method, url, response)
+            return response
 
-            print('> Receiving data...')
-            data = self.recvall(self.socket)
+        except RequestTimeout as e:
+            if sock is not None:
+                sock.close()
+            self.emit('error', method, url, e)
+            raise
 
         except Exception as e:
-            print("[ERROR in GET]: ", e)
-        
-        finally:
-            # Parse the response
-            code = self.get_code(data)
-            body = self.get_body(data)
+            # reported on response.error and the error hook, never printed, so the
+            # output of a caller is left to the caller
+            if sock is not None:
+                sock.close()
+            self.emit('error', method, url, e)
+            response = HTTPResponse(code, '')
+            response.error = e
+            response.timings = timings
+            return response
 
-            return HTTPResponse(code, body)
+    def GET(self, url, args=None, stream=False, timeout=None, headers=None):
+        '''
+            Sends a GET request to the server, or answers it from the cache if the client has one
+            
+            Args:
+                url     (str)   :   The requested url
+                stream  (bool)  :   Whether to return the body lazily as a StreamingHTTPResponse
+                timeout (Timeout or float)  :   The time limits of the request, the client default if None
+                headers (dict)  :   Extra request headers
+            
+            Returns:
+                response    (HTTPResponse)  :   The response from the server
+        '''
+        if self.cache is not None and not stream:
+            return self.cache.fetch(url, headers, lambda headers: self.request('GET', url, headers=headers, timeout=timeout))
+        return self.request('GET', url, headers=headers, stream=stream, timeout=timeout)
 
-    def POST(self, url, args=None):
+    def POST(self, url, args=None, stream=False, timeout=None, headers=None, body=None):
         '''
             Sends a POST request to the server
             References:
@@ -306,65 +2938,1015 @@ class HTTPClient(object):
                 - https://stackoverflow.com/questions/1278705/when-i-catch-an-exception-how-do-i-get-the-type-file-and-line-number
 
             Args:
-                url    (str)   :   The requested url
-                args   (dict)  :   The body to be sent to the server
+                url     (str)   :   The requested url
+                args    (dict)  :   The form fields to be sent to the server
+                stream  (bool)  :   Whether to return the body lazily as a StreamingHTTPResponse
+                timeout (Timeout or float)  :   The time limits of the request, the client default if None
+                headers (dict)  :   Extra request headers
+                body    (bytes, str, file or iterable)  :   A body to send instead of the form fields
             
             Returns:
-                response    (str)   :   The response from the server
+                response    (HTTPResponse)  :   The response from the server
 
         '''
-        code = 500
-        body = ""
+        return self.request('POST', url, body, headers, stream, timeout, args)
 
-        options = self.parse_url(url, args)
+    def command(self, url, command="GET", args=None, stream=False, timeout=None, headers=None, body=None):
+        if (command == "POST"):
+            return self.POST( url, args, stream, timeout, headers, body )
+        else:
+            return self.GET( url, args, stream, timeout, headers )
+
+    def pipeline(self, requests, depth=10, timeout=None):
+        '''
+            Sends GET requests to the same origin back-to-back on one connection and
+            reads the responses in order. If the server closes the connection part way
+            the rest are sent again on a new one, and if it will not answer more than
+            one request per connection the rest are sent one at a time.
+
+            References:
+                - https://datatracker.ietf.org/doc/html/rfc7230#section-6.3.2
+
+            Args:
+                requests    (list)  :   Each item is a url or a tuple of command() arguments,
+                                        only GETs are pipelined and the rest are sent in turn
+                depth       (int)   :   The most requests written before reading a response
+                timeout     (Timeout or float)  :   The time limits of each request, the client default if None
+
+            Returns:
+                responses   (list)  :   The HTTPResponse of each request, in the order given
+        '''
+        items = []
+        for item in requests:
+            if isinstance(item, str):
+                item = (item,)
+            items.append((tuple(item) + ("GET", None))[:3])
+
+        responses = [None] * len(items)
+        origins = {}
+        for index, (url, command, args) in enumerate(items):
+            if command == "GET":
+                options = self.parse_url(url)
+                origins.setdefault((options['host'], options['port']), []).append((index, url, options))
+            else:
+                responses[index] = self.command(url, command, args, timeout=timeout)
+
+        for (host, port), pending in origins.items():
+            while pending:
+                batch = pending[:depth]
+                done = self.pipeline_batch(host, port, batch, timeout)
+                for (index, url, options), response in zip(batch, done):
+                    response.url = url
+                    responses[index] = response
+                pending = pending[len(done):]
+                if pending and (not done or (len(done) < 2 and len(batch) > 1)):
+                    # the server does not answer, or does not keep the connection open
+                    # for a second response, so the rest are sent one at a time
+                    for index, url, options in pending:
+                        responses[index] = self.GET(url, timeout=timeout)
+                        responses[index].url = url
+                    break
+        return responses
+
+    def pipeline_batch(self, host, port, batch, timeout=None):
+        '''
+            Writes a batch of GET requests on one connection and reads as many responses as it can
+
+            Args:
+                host    (str)   :   The host of the origin
+                port    (int)   :   The port of the origin
+                batch   (list)  :   (index, url, options) for each request, options from parse_url
+                timeout (Timeout or float)  :   The time limits of the request, the client default if None
+
+            Returns:
+                responses   (list)  :   The responses read, in order, possibly fewer than the batch
+        '''
+        responses = []
+        deadline = self.deadline(timeout)
+        try:
+            sock = self.connect(host, port, deadline)
+        except RequestTimeout:
+            raise
+        except Exception as e:
+            responses = [HTTPResponse(500, '') for _ in batch]
+            for response in responses:
+                response.error = e
+            return responses
+
+        keep_alive = False
+        leftover = b''
+        buffer = ReceiveBuffer()
+        try:
+            self.sendall(sock, [part for _, _, options in batch for part in self.build_request(options, 'GET')], deadline)
+            for _ in batch:
+                parser = ResponseParser('GET')
+                decoder = None
+                body = bytearray()
+                data = leftover
+                while not parser.done:
+                    if not data:
+                        data = buffer.recv(sock, deadline)
+                        if not data:
+                            parser.feed_eof()
+                            break
+                    pieces = parser.feed(data)
+                    if decoder is None and parser.state != ResponseParser.STATUS and parser.state != ResponseParser.HEADERS:
+                        decoder = self.decoder(parser) or False
+                    for piece in pieces:
+                        if decoder:
+                            for out in decoder.decompress(piece):
+                                body.extend(out)
+                        else:
+                            body.extend(piece)
+                    data = b''
+                if decoder:
+                    body.extend(decoder.flush())
+                leftover = parser.unused
+                keep_alive = parser.keep_alive
+                response = HTTPResponse(parser.code, body, headers=parser.take_headers())
+                self.record_sizes(response, parser, body)
+                responses.append(response)
+                if not keep_alive:
+                    break
+        except RequestTimeout:
+            sock.close()
+            raise
+        except (OSError, HTTPClientError):
+            # whatever was not answered is sent again by the caller
+            keep_alive = False
+
+        self.release(host, port, keep_alive and not leftover and len(responses) == len(batch), sock)
+        return responses
+
+    def fetch_many(self, requests, max_workers=8, timeout=None):
+        '''
+            Runs many requests on a thread pool, sharing this client and its pool
+
+            Args:
+                requests    (list)  :   Each item is a url or a tuple of command() arguments
+                max_workers (int)   :   The number of worker threads
+                timeout     (Timeout or float)  :   The time limits of each request, the client default if None
+
+            Returns:
+                responses   (generator) :   The HTTPResponse of each request, in the order they complete.
+                                            A request that timed out has its RequestTimeout as error
+        '''
+        def run(item):
+            if isinstance(item, str):
+                item = (item,)
+            url, command, args = (tuple(item) + ("GET", None))[:3]
+            try:
+                response = self.command(url, command, args, timeout=timeout)
+            except RequestTimeout as e:
+                response = HTTPResponse(500, '')
+                response.error = e
+            response.url = url
+            return response
+
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(run, item) for item in requests]
+            for future in concurrent.futures.as_completed(futures):
+                yield future.result()
+    
+class AsyncHTTPClient(BaseHTTPClient):
+    '''
+        An asyncio version of HTTPClient built on asyncio streams. GET, POST and
+        command are coroutines returning an HTTPResponse, and gather runs many
+        requests at once with a bounded number in flight.
+
+        Args:
+            pool        (AsyncConnectionPool)   :   The pool to reuse connections from, a new one is made if not given
+            keep_alive  (bool)                  :   Whether to ask the server to keep the connection open
+            decompress  (bool)                  :   Whether to ask for gzip and deflate and decompress the body
+    '''
+    def __init__(self, pool=None, keep_alive=True, decompress=True):
+        self.pool = pool if pool is not None else AsyncConnectionPool()
+        self.decompress = decompress
+        self.builder = RequestBuilder(keep_alive, accept_encoding=self.ACCEPT_ENCODING if decompress else None)
+        self.keep_alive = keep_alive
+
+    async def connect(self, host, port):
+        '''
+            Opens a connection to the host and port, reusing a pooled one when possible
+
+            Args:
+                host    (str)   :   The host specified in the request
+                port    (int)   :   The port specified in the request
+
+            Returns:
+                conn    (tuple) :   The (reader, writer) pair of the connection
+        '''
+        import asyncio
+        conn = self.pool.acquire(host, port) if self.keep_alive else None
+        if conn is None:
+            conn = await asyncio.open_connection(host, port, happy_eyeballs_delay=0.25)
+        return conn
+
+    async def recvall(self, reader, method='GET'):
+        '''
+            Reads one response from the stream
+
+            Args:
+                reader  (StreamReader)  :   The stream to read from
+                method  (str)           :   The method of the request
+
+            Returns:
+                parser  (ResponseParser)    :   The parsed status line and headers
+                body    (bytearray)         :   The body received from the server
+        '''
+        parser = ResponseParser(method)
+        decoder = None
+        body = bytearray()
+        while not parser.done:
+            part = await reader.read(65536)
+            if not part:
+                parser.feed_eof()
+                break
+            pieces = parser.feed(part)
+            if decoder is None and parser.state != ResponseParser.STATUS and parser.state != ResponseParser.HEADERS:
+                decoder = self.decoder(parser) or False
+            for piece in pieces:
+                if decoder:
+                    for out in decoder.decompress(piece):
+                        body.extend(out)
+                else:
+                    body.extend(piece)
+        if decoder:
+            body.extend(decoder.flush())
+        return parser, body
+
+    async def request(self, options, command, request):
+        '''
+            Sends a built request and reads its response
+
+            Args:
+                options    (dict)   :   The parsed URL options
+                command    (str)    :   The method of the request
+                request    (list)   :   The request built by build_request
+
+            Returns:
+                response    (HTTPResponse)  :   The response from the server
+        '''
         host = options['host']
         port = options['port']
-        
-        
-        if options['query'] is None:
-            print("[ERROR]: No POST arguments provided")
-            code = 400
-            body = 'Bad Request'
-            return HTTPResponse(code, body)
-        
+        conn = None
         try:
-            # Connect to server and send data
-            print('> Connecting to server...')
-            self.connect(host, port)
-
-            # Build a request in bytes
-            request = self.build_request(options, 'POST')
-            # Send the request 
-            print('> Sending data...')
-            self.sendall(request)
-            
-            # Get the response 
-            print('> Receiving data...')
-            response = self.recvall(self.socket)
+            conn = await self.connect(host, port)
+            reader, writer = conn
+            writer.writelines(request)
+            await writer.drain()
+            parser, body = await self.recvall(reader, command)
+        except Exception as e:
+            if conn is not None:
+                self.pool.discard(conn)
+            response = HTTPResponse(500, '')
+            response.error = e
+            return response
+
+        if self.keep_alive and parser.keep_alive:
+            self.pool.release(host, port, conn)
+        else:
+            self.pool.discard(conn)
+        response = HTTPResponse(parser.code, body, headers=parser.take_headers())
+        response.raw_bytes = parser.body_bytes
+        response.decoded_bytes = len(body)
+        return response
+
+    async def GET(self, url, args=None):
+        options = self.parse_url(url)
+        return await self.request(options, 'GET', self.build_request(options, 'GET'))
+
+    async def POST(self, url, args=None):
+        options = self.parse_url(url, args)
+        if options['query'] is None:
+            return HTTPResponse(400, 'Bad Request')
+        return await self.request(options, 'POST', self.build_request(options, 'POST'))
+
+    async def command(self, url, command="GET", args=None):
+        if (command == "POST"):
+            return await self.POST( url, args )
+        else:
+            return await self.GET( url, args )
+
+    async def gather(self, requests, limit=10):
+        '''
+            Runs many requests concurrently, with at most limit of them in flight
+
+            Args:
+                requests    (list)  :   Each item is a url or a tuple of command() arguments
+                limit       (int)   :   The maximum number of requests in flight
+
+            Returns:
+                responses   (list)  :   The HTTPResponse of each request, in the order given
+        '''
+        import asyncio
+        semaphore = asyncio.Semaphore(limit)
+
+        async def run(item):
+            if isinstance(item, str):
+                item = (item,)
+            async with semaphore:
+                return await self.command(*item)
+
+        return await asyncio.gather(*(run(item) for item in requests))
+
+    def close(self):
+        self.pool.close()
+
+def crawl_worker(urls, results, threads, delay, max_per_host, timeout, include_body):
+    '''
+        Runs in a crawl process: fetches the urls sent on its queue with its own
+        client and pool, and puts a result dict for each on the results queue,
+        then None once it is told to stop
+    '''
+    scheduler = HostScheduler(rate=1 / delay if delay else None, max_in_flight=max_per_host)
+    client = HTTPClient(ConnectionPool(max_size=max_per_host), timeout=timeout, scheduler=scheduler, retry=Retry())
+    # bounds the urls taken off the queue but not yet fetched
+    slots = threading.Semaphore(threads * 2)
 
+    def fetch(url):
+        result = {'url': url}
+        try:
+            response = client.GET(url)
+            if response.error is not None:
+                result['error'] = f'{type(response.error).__name__}: {response.error}'
+            else:
+                result.update(code=response.code, bytes=response.decoded_bytes,
+                              elapsed=round(sum(hop.elapsed for hop in response.redirects) + response.elapsed, 6),
+                              reused=response.timings.reused, redirects=len(response.redirects))
+                if include_body:
+                    result['body'] = response.body
         except Exception as e:
-            exc_type, exc_obj, exc_tb = sys.exc_info()
-            print(f'[{exc_type} in line {exc_tb.tb_lineno}]: {e}')
-        
+            result['error'] = f'{type(e).__name__}: {e}'
         finally:
-            code = self.get_code(response)
-            body = self.get_body(response)
+            slots.release()
+        results.put(result)
 
-        return HTTPResponse(code, body)
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        while True:
+            url = urls.get()
+            if url is None:
+                break
+            slots.acquire()
+            executor.submit(fetch, url)
+    client.close()
+    results.put(None)
 
-    def command(self, url, command="GET", args=None):
-        if (command == "POST"):
-            return self.POST( url, args )
+def crawl(urls, output, processes=None, threads=8, delay=0.0, max_per_host=2, timeout=None,
+          include_body=False, queue_size=1000):
+    '''
+        Fetches every url across a pool of processes and writes one JSON result per line.
+        Urls are read lazily and sent to the process that owns their host, so each host
+        is fetched from a single connection pool and HostScheduler, which keeps to the
+        politeness limits and backs off when a host answers 429 or 503.
+        The queues between the processes are bounded, so memory stays flat however
+        long the input is.
+
+        Args:
+            urls            (iterable)  :   The urls, one per item, such as the lines of a file. Blank
+                                            lines and lines starting with # are skipped
+            output          (file)      :   The text file to write the results to
+            processes       (int)       :   The number of worker processes, the number of cores if None
+            threads         (int)       :   The requests in flight per process
+            delay           (float)     :   The least seconds between request starts to one host
+            max_per_host    (int)       :   The most requests in flight to one host
+            timeout         (Timeout or float)  :   The time limits of each request
+            include_body    (bool)      :   Whether to include the body in each result
+            queue_size      (int)       :   The most urls or results waiting in each queue
+
+        Returns:
+            summary (dict)  :   The number of urls fetched and of errors
+    '''
+    import json
+    import multiprocessing
+    import queue
+    processes = processes or os.cpu_count() or 1
+    context = multiprocessing.get_context()
+    queues = [context.Queue(queue_size) for _ in range(processes)]
+    results = context.Queue(queue_size)
+    workers = [context.Process(target=crawl_worker, daemon=True,
+                               args=(urls_queue, results, threads, delay, max_per_host, timeout, include_body))
+               for urls_queue in queues]
+    for worker in workers:
+        worker.start()
+
+    summary = {'urls': 0, 'errors': 0}
+
+    def write_results():
+        running = processes
+        while running:
+            try:
+                result = results.get(timeout=1.0)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    break
+                continue
+            if result is None:
+                running -= 1
+                continue
+            summary['urls'] += 1
+            if 'error' in result:
+                summary['errors'] += 1
+            output.write(json.dumps(result) + '\n')
+
+    writer = threading.Thread(target=write_results)
+    writer.start()
+    for line in urls:
+        url = line.strip()
+        if not url or url.startswith('#'):
+            continue
+        host = urlparse(url).hostname or ''
+        queues[zlib.crc32(host.encode('utf-8')) % processes].put(url)
+    for urls_queue in queues:
+        urls_queue.put(None)
+    writer.join()
+    for worker in workers:
+        worker.join()
+    output.flush()
+    return summary
+
+def crawl_main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='httpclient.py crawl', description='Fetch a list of urls')
+    parser.add_argument('input', nargs='?', default='-', help='the file of urls, one per line, or - for stdin')
+    parser.add_argument('-o', '--output', default='-', help='the file to write JSON lines to, or - for stdout')
+    parser.add_argument('-p', '--processes', type=int, help='worker processes (default: one per core)')
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='requests in flight per process (default 8)')
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds between requests to one host')
+    parser.add_argument('--per-host', type=int, default=2, help='requests in flight to one host (default 2)')
+    parser.add_argument('-t', '--timeout', type=float, help='seconds each request may take')
+    parser.add_argument('--body', action='store_true', help='include the body in each result')
+    args = parser.parse_args(argv)
+    source = sys.stdin if args.input == '-' else open(args.input)
+    output = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        summary = crawl(source, output, args.processes, args.concurrency, args.delay, args.per_host,
+                        args.timeout, args.body)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+    print(f"fetched {summary['urls']} urls, {summary['errors']} errors", file=sys.stderr)
+
+def percentile(values, p):
+    '''
+        Returns the nearest-rank percentile of sorted values
+
+        Args:
+            values  (list)  :   The values, sorted ascending
+            p       (float) :   The percentile, from 0 to 100
+    '''
+    if not values:
+        return 0.0
+    rank = -(-len(values) * p // 100)
+    return values[max(0, min(len(values), int(rank)) - 1)]
+
+def bench(url, concurrency=10, requests=None, duration=None, keep_alive=True, method='GET', timeout=None):
+    '''
+        Drives a url with concurrent requests from one shared HTTPClient and measures it.
+        Stops after the given number of requests or seconds, whichever comes first,
+        and after 100 requests if neither is given.
+
+        Args:
+            url         (str)   :   The url to request
+            concurrency (int)   :   The number of requests kept in flight
+            requests    (int)   :   The number of requests to send
+            duration    (float) :   The seconds to keep sending for
+            keep_alive  (bool)  :   Whether to reuse connections
+            method      (str)   :   GET or POST
+            timeout     (Timeout or float)  :   The time limits of each request
+
+        Returns:
+            stats   (dict)  :   requests, errors, status counts, seconds, requests and bytes per second,
+                                the latency percentiles p50, p90, p99 and max in seconds, and bytes received
+    '''
+    if requests is None and duration is None:
+        requests = 100
+    # a retry would hide a failed request behind the one that followed it
+    client = HTTPClient(ConnectionPool(max_size=concurrency, max_total=concurrency), keep_alive=keep_alive, timeout=timeout,
+                        retry=Retry(max_attempts=1))
+    lock = threading.Lock()
+    latencies = []
+    statuses = {}
+    totals = {'sent': 0, 'errors': 0, 'bytes': 0}
+
+    def worker():
+        while True:
+            with lock:
+                if requests is not None and totals['sent'] >= requests:
+                    return
+                if stop is not None and time.monotonic() >= stop:
+                    return
+                totals['sent'] += 1
+            started = time.perf_counter()
+            try:
+                response = client.command(url, method)
+            except RequestTimeout:
+                response = None
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if response is None or response.error is not None:
+                    totals['errors'] += 1
+                    continue
+                statuses[response.code] = statuses.get(response.code, 0) + 1
+                totals['bytes'] += response.timings.received_bytes
+
+    started = time.monotonic()
+    stop = None if duration is None else started + duration
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.monotonic() - started
+    client.close()
+
+    latencies.sort()
+    return {'requests': len(latencies), 'errors': totals['errors'], 'status': statuses,
+            'seconds': seconds, 'rps': len(latencies) / seconds if seconds else 0.0,
+            'p50': percentile(latencies, 50), 'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99), 'max': latencies[-1] if latencies else 0.0,
+            'bytes': totals['bytes'], 'bytes_per_second': totals['bytes'] / seconds if seconds else 0.0}
+
+def format_bench(stats):
+    '''
+        Formats the result of bench() as a report
+    '''
+    status = ', '.join(f'{code}: {count}' for code, count in sorted(stats['status'].items())) or '-'
+    latency = '  '.join(f"{name} {stats[name] * 1000:.2f}ms" for name in ('p50', 'p90', 'p99', 'max'))
+    return '\n'.join([
+        f"requests    {stats['requests']} in {stats['seconds']:.2f}s ({stats['rps']:.1f} req/s)",
+        f"errors      {stats['errors']}",
+        f"status      {status}",
+        f"latency     {latency}",
+        f"transfer    {stats['bytes']} bytes ({stats['bytes_per_second'] / 1024:.1f} KiB/s)",
+    ])
+
+def bench_main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='httpclient.py bench', description='Load test a url')
+    parser.add_argument('url')
+    parser.add_argument('-c', '--concurrency', type=int, default=10, help='requests in flight (default 10)')
+    parser.add_argument('-n', '--requests', type=int, help='number of requests to send (default 100)')
+    parser.add_argument('-d', '--duration', type=float, help='seconds to send for')
+    parser.add_argument('-m', '--method', default='GET', choices=('GET', 'POST'))
+    parser.add_argument('-t', '--timeout', type=float, help='seconds each request may take')
+    parser.add_argument('--no-keep-alive', dest='keep_alive', action='store_false', help='open a connection per request')
+    args = parser.parse_args(argv)
+    print(format_bench(bench(args.url, args.concurrency, args.requests, args.duration,
+                             args.keep_alive, args.method, args.timeout)))
+
+def preallocate(fd, size):
+    '''
+        Reserves size bytes for a file, so parallel writes do not fragment it or run out of space part way
+    '''
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            # the file system does not support it
+            pass
+    os.ftruncate(fd, size)
+
+def pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+def download(url, path, segments=4, timeout=None, min_segment=1024 * 1024, client=None):
+    '''
+        Downloads a url straight to disk. A first request asks for one byte: if the
+        server answers with a range, the file is preallocated and split into segments
+        that are fetched in parallel, each on its own connection, and written at their
+        offsets with os.pwrite. Otherwise the body of that first response is streamed
+        to the file. Progress is kept in a PATH.progress file next to the download,
+        so one that is interrupted resumes each segment where it stopped, as long as
+        the file on the server still has the same validator.
+
+        Args:
+            url         (str)   :   The url to download
+            path        (str)   :   The file to write
+            segments    (int)   :   The most ranges fetched in parallel
+            timeout     (Timeout or float)  :   The time limits of each request
+            min_segment (int)   :   The least bytes per segment
+            client      (HTTPClient)    :   The client to use, one that does not decompress is made if not given
+
+        Returns:
+            summary (dict)  :   The bytes in the file, the segments used, the bytes resumed and the seconds taken
+    '''
+    import concurrent.futures
+    import json
+    if client is None:
+        client = HTTPClient(ConnectionPool(max_size=segments), timeout=timeout, decompress=False)
+    started = time.monotonic()
+    response = client.GET(url, stream=True, headers={'Range': 'bytes=0-0'})
+    if response.error is not None:
+        raise response.error
+    if response.code == 200:
+        with open(path, 'wb') as f:
+            size = response.write_to(f)
+        return {'bytes': size, 'segments': 1, 'resumed': 0, 'seconds': time.monotonic() - started}
+    if response.code == 416 and response.headers.get('content-range', '').endswith('/0'):
+        # no range of an empty file can be satisfied
+        response.close()
+        open(path, 'wb').close()
+        return {'bytes': 0, 'segments': 1, 'resumed': 0, 'seconds': time.monotonic() - started}
+    if response.code != 206:
+        response.close()
+        raise HTTPClientError(f'GET {url} returned {response.code}')
+    response.read()
+    url = response.url
+    total = response.headers.get('content-range', '').rpartition('/')[2]
+    if not total.isdigit():
+        raise ProtocolError('invalid Content-Range: ' + response.headers.get('content-range', ''))
+    size = int(total)
+    validator = response.headers.get('etag') or response.headers.get('last-modified')
+
+    sidecar = path + '.progress'
+    progress = None
+    try:
+        with open(sidecar) as f:
+            progress = json.load(f)
+        if (progress['url'], progress['size'], progress['validator']) != (url, size, validator) \
+                or os.path.getsize(path) != size:
+            progress = None
+    except (OSError, ValueError, KeyError):
+        progress = None
+    resumed = 0
+    if progress is None:
+        count = max(1, min(segments, size // min_segment))
+        bounds = [size * i // count for i in range(count + 1)]
+        # [start, end, bytes done]
+        progress = {'url': url, 'size': size, 'validator': validator,
+                    'segments': [[bounds[i], bounds[i + 1], 0] for i in range(count)]}
+    else:
+        resumed = sum(segment[2] for segment in progress['segments'])
+    lock = threading.Lock()
+
+    def save():
+        with open(sidecar + '.tmp', 'w') as f:
+            json.dump(progress, f)
+        os.replace(sidecar + '.tmp', sidecar)
+
+    def fetch(segment):
+        start, end, done = segment
+        if start + done >= end:
+            return
+        headers = {'Range': f'bytes={start + done}-{end - 1}'}
+        if validator is not None:
+            headers['If-Range'] = validator
+        response = client.GET(url, stream=True, headers=headers)
+        if response.error is not None:
+            raise response.error
+        if response.code != 206:
+            response.close()
+            raise HTTPClientError(f'expected 206 for bytes {start + done}-{end - 1}, got {response.code}')
+        offset = start + done
+        saved = time.monotonic()
+        for piece in response.iter_content():
+            pwrite_all(fd, piece, offset)
+            offset += len(piece)
+            with lock:
+                # only record bytes once they are written
+                segment[2] = offset - start
+                if time.monotonic() - saved > 1.0:
+                    save()
+                    saved = time.monotonic()
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if not resumed:
+            preallocate(fd, size)
+            # preallocating never shrinks a file that was already there
+            os.ftruncate(fd, size)
+        save()
+        with concurrent.futures.ThreadPoolExecutor(len(progress['segments'])) as executor:
+            futures = [executor.submit(fetch, segment) for segment in progress['segments']]
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            with lock:
+                save()
+            raise errors[0]
+    finally:
+        os.close(fd)
+    os.remove(sidecar)
+    return {'bytes': size, 'segments': len(progress['segments']), 'resumed': resumed,
+            'seconds': time.monotonic() - started}
+
+def download_main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='httpclient.py', description='Download a url to a file')
+    parser.add_argument('url')
+    parser.add_argument('-o', '--output', required=True, help='the file to write')
+    parser.add_argument('-s', '--segments', type=int, default=4, help='ranges fetched in parallel (default 4)')
+    parser.add_argument('-t', '--timeout', type=float, help='seconds each request may take')
+    args = parser.parse_args(argv)
+    summary = download(args.url, args.output, args.segments, args.timeout)
+    rate = summary['bytes'] / summary['seconds'] / 1e6 if summary['seconds'] else 0.0
+    print(f"wrote {summary['bytes']} bytes to {args.output} in {summary['seconds']:.2f}s "
+          f"({rate:.1f} MB/s, {summary['segments']} segments, {summary['resumed']} bytes resumed)", file=sys.stderr)
+
+def daemon_socket():
+    '''
+        Returns the Unix socket path of the daemon, from $HTTPCLIENT_SOCKET or else a
+        file in a per-user directory in $XDG_RUNTIME_DIR or /tmp
+    '''
+    return (os.environ.get('HTTPCLIENT_SOCKET')
+            or os.path.join(os.environ.get('XDG_RUNTIME_DIR') or '/tmp', f'httpclient-{os.getuid()}', 'daemon.sock'))
+
+def check_socket(path):
+    '''
+        Checks that a daemon socket can be trusted before it is connected to or
+        removed: it must be a socket owned by the current user, in a directory that
+        only the current user or root can change or that has the sticky bit set,
+        so another user can neither plant the socket nor swap it.
+
+        Args:
+            path    (str)   :   The path of the socket
+
+        Returns:
+            exists  (bool)  :   Whether there is a socket at the path
+    '''
+    directory = os.stat(os.path.dirname(os.path.abspath(path)))
+    if directory.st_uid not in (os.getuid(), 0) or \
+            (directory.st_mode & 0o022 and not directory.st_mode & S_ISVTX):
+        raise HTTPClientError(f'the directory of {path} may be changed by other users')
+    try:
+        status = os.lstat(path)
+    except FileNotFoundError:
+        return False
+    if not S_ISSOCK(status.st_mode) or status.st_uid != os.getuid():
+        raise HTTPClientError(f'{path} is not a socket owned by this user')
+    return True
+
+def serve(path, client=None, idle=None):
+    '''
+        Answers requests from other httpclient.py processes on a Unix socket with one
+        warm client, so repeated calls from the command line share its connection pool
+        and skip the start-up imports. Each connection carries one request, a JSON line
+        followed by the body, and gets back a JSON line with the status, headers, timings
+        and error of the response, followed by its body until the connection closes.
+
+        Args:
+            path    (str)           :   The path of the socket, only the current user may connect to it
+            client  (HTTPClient)    :   The client to send the requests with, a new one is made if not given
+            idle    (float)         :   Seconds without a new request before the daemon exits, None to run until killed
+    '''
+    import json
+    os.makedirs(os.path.dirname(os.path.abspath(path)), 0o700, exist_ok=True)
+    if check_socket(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            # left behind by a daemon that did not exit cleanly
+            os.unlink(path)
         else:
-            return self.GET( url, args )
-    
-if __name__ == "__main__":
-    client = HTTPClient()
-    command = "GET"
-    if (len(sys.argv) <= 1):
+            raise HTTPClientError(f'a daemon is already listening on {path}')
+        finally:
+            probe.close()
+    client = client or HTTPClient()
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(umask)
+    listener.listen(64)
+    listener.settimeout(idle)
+
+    def handle(conn):
+        with conn, conn.makefile('rb') as reader:
+            request = json.loads(reader.readline())
+            body = reader.read(request['length']) if request.get('length') is not None else None
+            timeout = Timeout(*request['timeout']) if request.get('timeout') else None
+            try:
+                response = client.request(request['method'], request['url'], body, request.get('headers'),
+                                          timeout=timeout)
+            except RequestTimeout as e:
+                response = HTTPResponse(500, b'', request['url'])
+                response.error = e
+            error = response.error
+            reply = {'code': response.code, 'url': response.url, 'headers': response.headers.items(),
+                     'timings': response.timings.as_dict() if response.timings is not None else None,
+                     'error': None if error is None else [type(error).__name__, str(error)]}
+            conn.sendall(json.dumps(reply).encode('utf-8') + b'\n')
+            conn.sendall(response.content if error is None else b'')
+
+    threads = []
+    try:
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except socket.timeout:
+                break
+            threads = [thread for thread in threads if thread.is_alive()]
+            thread = threading.Thread(target=handle, args=(conn,))
+            thread.start()
+            threads.append(thread)
+    finally:
+        listener.close()
+        os.unlink(path)
+        for thread in threads:
+            thread.join()
+        client.close()
+
+def daemon_request(path, method, url, body=None, headers=None, timeout=None):
+    '''
+        Sends a request through the daemon that serve() runs on a Unix socket
+
+        Args:
+            path    (str)   :   The path of the daemon's socket
+            method  (str)   :   The method of the request
+            url     (str)   :   The requested url
+            body    (bytes or str)  :   The body to send
+            headers (dict)  :   Extra request headers
+            timeout (Timeout or float)  :   The time limits of the request, the daemon's default if None
+
+        Returns:
+            response    (HTTPResponse)  :   The response, or None if no daemon is listening on the path
+    '''
+    import json
+    try:
+        if not check_socket(path):
+            return None
+    except FileNotFoundError:
+        # not even its directory is there yet
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    if timeout is not None:
+        timeout = Timeout.coerce(timeout)
+        timeout = [timeout.connect, timeout.read, timeout.total]
+    request = {'method': method, 'url': url, 'headers': headers, 'timeout': timeout,
+               'length': None if body is None else len(body)}
+    with sock, sock.makefile('rb') as reader:
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n' + (body or b''))
+        line = reader.readline()
+        if not line:
+            raise ProtocolError(f'the daemon on {path} closed the connection')
+        reply = json.loads(line)
+        response = HTTPResponse(reply['code'], reader.read(), reply['url'], Headers(reply['headers']))
+    if reply['timings'] is not None:
+        response.timings = Timings()
+        for name, value in reply['timings'].items():
+            setattr(response.timings, name, value)
+    if reply['error'] is not None:
+        name, message = reply['error']
+        error = globals().get(name)
+        if not (isinstance(error, type) and issubclass(error, HTTPClientError)):
+            error, message = HTTPClientError, f'{name}: {message}'
+        response.error = error(message)
+    return response
+
+def start_daemon(path, idle=300.0, wait=5.0):
+    '''
+        Starts serve() on the path in a detached process and waits for it to listen
+
+        Args:
+            path    (str)   :   The path of the socket
+            idle    (float) :   Seconds without a new request before the daemon exits
+            wait    (float) :   The most seconds to wait for it to listen
+    '''
+    import subprocess
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), 'daemon', path, '--idle', str(idle)],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     start_new_session=True)
+    end = time.monotonic() + wait
+    while time.monotonic() < end:
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            return
+        except (FileNotFoundError, ConnectionRefusedError):
+            time.sleep(0.01)
+        finally:
+            probe.close()
+    raise HTTPClientError(f'the daemon did not start listening on {path}')
+
+def daemon_main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='httpclient.py daemon',
+                                     description='Serve requests from other httpclient.py calls with one warm client')
+    parser.add_argument('socket', nargs='?', help='the Unix socket to listen on (default $HTTPCLIENT_SOCKET)')
+    parser.add_argument('--idle', type=float, help='exit after this many seconds without a request')
+    args = parser.parse_args(argv)
+    serve(args.socket or daemon_socket(), idle=args.idle)
+
+def request_main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='httpclient.py', description='Send one request and print the response')
+    parser.add_argument('command', nargs='?', metavar='METHOD', help='the method, like -X')
+    parser.add_argument('url')
+    parser.add_argument('-X', '--request', dest='method', help='the method (default GET, or POST with -d)')
+    parser.add_argument('-H', '--header', action='append', default=[], help="a header as 'Name: value', may be repeated")
+    parser.add_argument('-d', '--data', help='the body to send, @FILE to read it from a file or @- from stdin')
+    parser.add_argument('-t', '--timeout', type=float, help='seconds to wait to connect and for each read')
+    parser.add_argument('--connect-timeout', type=float, help='seconds to wait to connect')
+    parser.add_argument('-m', '--max-time', type=float, help='seconds the whole request may take')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print the status, headers and timings to stderr')
+    parser.add_argument('--socket', help='send the request through the daemon on this Unix socket if one is '
+                                         'listening (default $HTTPCLIENT_SOCKET)')
+    parser.add_argument('--daemon', action='store_true', help='send the request through the daemon, '
+                                                              'starting one if none is listening')
+    parser.add_argument('--idle', type=float, default=300.0, help='seconds a daemon started by --daemon '
+                                                                   'waits for a request before exiting (default 300)')
+    args = parser.parse_args(argv)
+
+    method = (args.command or args.method or ('POST' if args.data is not None else 'GET')).upper()
+    headers = {}
+    for header in args.header:
+        name, sep, value = header.partition(':')
+        if not sep:
+            parser.error(f"header {header!r} is not 'Name: value'")
+        headers[name.strip()] = value.strip()
+    body = args.data
+    if body is not None and body.startswith('@'):
+        if body == '@-':
+            body = sys.stdin.buffer.read()
+        else:
+            with open(body[1:], 'rb') as f:
+                body = f.read()
+    if body is not None and not any(name.lower() == 'content-type' for name in headers):
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    timeout = None
+    if args.timeout is not None or args.connect_timeout is not None or args.max_time is not None:
+        timeout = Timeout(args.connect_timeout if args.connect_timeout is not None else args.timeout,
+                          args.timeout, args.max_time)
+
+    response = None
+    path = args.socket or (daemon_socket() if args.daemon or 'HTTPCLIENT_SOCKET' in os.environ else None)
+    if path is not None:
+        response = daemon_request(path, method, args.url, body, headers, timeout)
+        if response is None and args.daemon:
+            start_daemon(path, args.idle)
+            response = daemon_request(path, method, args.url, body, headers, timeout)
+    if response is None:
+        client = HTTPClient()
+        try:
+            response = client.request(method, args.url, body, headers, timeout=timeout)
+        except RequestTimeout as e:
+            response = HTTPResponse(500, b'', args.url)
+            response.error = e
+        finally:
+            client.close()
+
+    if args.verbose:
+        print(f'< {response.code} {response.url}', file=sys.stderr)
+        for name, value in response.headers.items():
+            print(f'< {name}: {value}', file=sys.stderr)
+        if response.timings is not None:
+            timings = response.timings.as_dict()
+            print('* ' + ' '.join(f'{phase} {timings[phase] * 1000:.1f}ms' for phase in Timings.PHASES
+                                  if timings[phase] is not None)
+                  + f" sent {timings['sent_bytes']} received {timings['received_bytes']}"
+                  + (' reused' if timings['reused'] else ''), file=sys.stderr)
+    if response.error is not None:
+        print(f'{type(response.error).__name__}: {response.error}', file=sys.stderr)
+        return 1
+    print(response)
+    return 0
+
+def main(argv=None):
+    '''
+        The command line entry point. Run it as python -m httpclient to start from the
+        cached bytecode, a script given by path is compiled again on every run.
+
+        Args:
+            argv    (list)  :   The arguments, sys.argv[1:] if None
+
+        Returns:
+            status  (int)   :   The exit status
+    '''
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
         help()
-        sys.exit(1)
-    elif (len(sys.argv) == 3): 
-        print(client.command( sys.argv[2], sys.argv[1] ))
+        return 1
+    if argv[0] == 'bench':
+        bench_main(argv[1:])
+    elif argv[0] == 'crawl':
+        crawl_main(argv[1:])
+    elif argv[0] == 'daemon':
+        daemon_main(argv[1:])
+    elif '-o' in argv or '--output' in argv:
+        download_main(argv)
     else:
-        print(client.command( sys.argv[1] ))
+        return request_main(argv)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# Copyright 2022 Della Humanita
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# run python perftests.py to run the regression suite against a local server,
+#     python perftests.py --json results.json to save the results,
+#     python perftests.py --baseline results.json --threshold 0.1 to compare with saved results,
+#     python perftests.py --micro for the receive and header parsing micro benchmarks
+
+import argparse
+import http.server
+import json
+import platform
+import socket
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+import httpclient
+
+BODY_SIZE = 32 * 1024 * 1024
+
+def make_response(size=BODY_SIZE):
+    body = b'x' * size
+    return b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % size + body
+
+def serve_once(sock, data):
+    '''send data on sock from a thread, then close it'''
+    def run():
+        sock.sendall(data)
+        sock.close()
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+# the receive loop recvall() used before recv_into, kept as the baseline
+def legacy_recvall(sock):
+    buffer = bytearray()
+    while True:
+        part = sock.recv(1024)
+        if not part:
+            break
+        buffer.extend(part)
+    return buffer.decode('utf-8')
+
+def recv_into_recvall(sock):
+    return httpclient.HTTPClient().recvall(sock)
+
+class CountingSocket(object):
+    '''
+    wraps a socket to count the receive buffers allocated while reading from it:
+    every recv() returns a new bytes object, while recv_into() only counts a buffer,
+    or a new size of one, that it has not filled before
+    '''
+    def __init__(self, sock):
+        self.sock = sock
+        self.allocations = 0
+        self.buffers = set()
+
+    def recv(self, size, *args):
+        self.allocations += 1
+        return self.sock.recv(size, *args)
+
+    def recv_into(self, buffer, *args):
+        owner = buffer.obj if isinstance(buffer, memoryview) else buffer
+        key = (id(owner), len(owner))
+        if key not in self.buffers:
+            self.buffers.add(key)
+            self.allocations += 1
+        return self.sock.recv_into(buffer, *args)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+def measure(reader, data):
+    '''returns (MB/s, peak traced MB, receive buffers allocated) for reading data with reader'''
+    ours, theirs = socket.socketpair()
+    thread = serve_once(theirs, data)
+    start = time.perf_counter()
+    reader(ours)
+    elapsed = time.perf_counter() - start
+    thread.join()
+    ours.close()
+
+    ours, theirs = socket.socketpair()
+    thread = serve_once(theirs, data)
+    tracemalloc.start()
+    reader(ours)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    thread.join()
+    ours.close()
+
+    ours, theirs = socket.socketpair()
+    thread = serve_once(theirs, data)
+    counting = CountingSocket(ours)
+    reader(counting)
+    thread.join()
+    ours.close()
+    return len(data) / elapsed / 1e6, peak / 1e6, counting.allocations
+
+HEADER_BLOCK = (
+    b'HTTP/1.1 200 OK\r\n'
+    b'Date: Tue, 18 Oct 2022 18:27:59 GMT\r\n'
+    b'Server: Apache/2.4.41 (Ubuntu)\r\n'
+    b'Content-Type: text/html; charset=UTF-8\r\n'
+    b'Content-Length: 40213\r\n'
+    b'Connection: keep-alive\r\n'
+    b'Keep-Alive: timeout=5, max=100\r\n'
+    b'Cache-Control: max-age=0, private, must-revalidate\r\n'
+    b'ETag: W/"9d3c-5ea4fc0a9b3c0"\r\n'
+    b'Last-Modified: Mon, 17 Oct 2022 09:12:31 GMT\r\n'
+    b'Vary: Accept-Encoding\r\n'
+    b'Set-Cookie: session=8f14e45fceea167a5a36dedd4bea2543; Path=/; HttpOnly\r\n'
+    b'Set-Cookie: lang=en; Path=/; Expires=Wed, 18 Oct 2023 18:27:59 GMT\r\n'
+    b'X-Frame-Options: SAMEORIGIN\r\n'
+    b'X-Content-Type-Options: nosniff\r\n'
+    b'Strict-Transport-Security: max-age=31536000; includeSubDomains\r\n'
+    b'\r\n'
+)
+
+# the split-based header parsing recvall() used before Headers, kept as the baseline
+def legacy_parse_header(data):
+    header = data.decode('utf-8').split('\r\n\r\n')[0]
+    header_dict = {}
+    for line in header.split('\r\n'):
+        if ':' in line:
+            key, value = line.split(': ')
+            header_dict[key] = value
+    return header_dict
+
+def headers_parse(data):
+    end = data.find(b'\r\n\r\n')
+    return httpclient.Headers.parse(data[data.find(b'\r\n') + 2:end])
+
+# parsing and then looking one header up, which is when Headers builds its index
+def headers_parse_get(data):
+    return headers_parse(data).get('content-type')
+
+# several lookups, as the response cache makes for a cacheable response
+def headers_parse_get_many(data):
+    headers = headers_parse(data)
+    for name in ('content-type', 'cache-control', 'etag', 'last-modified', 'vary', 'expires'):
+        headers.get(name)
+
+def bench_headers(rounds=100000):
+    for name, parse in [('split', legacy_parse_header), ('Headers', headers_parse), ('Headers+get', headers_parse_get),
+                        ('Headers+6get', headers_parse_get_many)]:
+        start = time.perf_counter()
+        for _ in range(rounds):
+            parse(HEADER_BLOCK)
+        elapsed = time.perf_counter() - start
+        print("%-12s %8.2f us/block" % (name, elapsed / rounds * 1e6))
+
+def bench_receive():
+    data = make_response()
+    for name, reader in [('recv(1024)', legacy_recvall), ('recv_into', recv_into_recvall)]:
+        rate, peak, allocations = measure(reader, data)
+        print("%-12s %8.1f MB/s  peak %6.1f MB  %6d buffers" % (name, rate, peak, allocations))
+
+LARGE_SIZE = 16 * 1024 * 1024
+SMALL_BODY = b'ok'
+LARGE_BODY = b'x' * LARGE_SIZE
+CHUNK = b'c' * 16384
+CHUNKS = 256
+
+# An HTTP/1.1 stand-in server, like MyHTTPHandler in freetests.py but threaded and keep-alive.
+# Each response is written in one call so Nagle's algorithm on the server does not add latency.
+class PerfHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self, body):
+        self.wfile.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+
+    def do_GET(self):
+        if self.path == '/large':
+            self.respond(LARGE_BODY)
+        elif self.path == '/chunked':
+            frame = b'%x\r\n' % len(CHUNK) + CHUNK + b'\r\n'
+            self.wfile.write(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n' + frame * CHUNKS + b'0\r\n\r\n')
+        else:
+            self.respond(SMALL_BODY)
+
+    def do_POST(self):
+        self.respond(self.rfile.read(int(self.headers['Content-Length'])))
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), PerfHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def expect_ok(response):
+    '''fails the case unless the request succeeded, so a failing client cannot look fast'''
+    if response.error is not None or response.code != 200:
+        raise AssertionError('%s %r' % (response.code, response.error))
+    return response
+
+def expect_size(body, size):
+    if len(body) != size:
+        raise AssertionError('read %d bytes of %d' % (len(body), size))
+
+def case_small_get(base, count=500):
+    '''median latency of small GETs on a kept-alive connection'''
+    client = httpclient.HTTPClient()
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        expect_ok(client.GET(base + '/small'))
+        latencies.append(time.perf_counter() - start)
+    client.close()
+    return statistics.median(latencies) * 1000, 'ms', 'lower'
+
+def case_large_get(base, count=3):
+    '''throughput of GETs with a large Content-Length body'''
+    client = httpclient.HTTPClient()
+    start = time.perf_counter()
+    for _ in range(count):
+        expect_size(expect_ok(client.GET(base + '/large', stream=True)).read(), LARGE_SIZE)
+    elapsed = time.perf_counter() - start
+    client.close()
+    return LARGE_SIZE * count / elapsed / 1e6, 'MB/s', 'higher'
+
+def case_small_posts(base, count=500):
+    '''rate of small POSTs on a kept-alive connection'''
+    client = httpclient.HTTPClient()
+    start = time.perf_counter()
+    for _ in range(count):
+        expect_ok(client.POST(base + '/post', body=b'a=1&b=2'))
+    elapsed = time.perf_counter() - start
+    client.close()
+    return count / elapsed, 'req/s', 'higher'
+
+def case_chunked_get(base, count=5):
+    '''throughput of GETs with a chunked body'''
+    client = httpclient.HTTPClient()
+    start = time.perf_counter()
+    for _ in range(count):
+        expect_size(expect_ok(client.GET(base + '/chunked', stream=True)).read(), len(CHUNK) * CHUNKS)
+    elapsed = time.perf_counter() - start
+    client.close()
+    return len(CHUNK) * CHUNKS * count / elapsed / 1e6, 'MB/s', 'higher'
+
+def case_concurrent(base, count=1000):
+    '''rate of small GETs from 8 threads sharing a client'''
+    stats = httpclient.bench(base + '/small', concurrency=8, requests=count)
+    if stats['errors'] or stats['status'] != {200: count}:
+        raise AssertionError('%d errors, status %r' % (stats['errors'], stats['status']))
+    return stats['rps'], 'req/s', 'higher'
+
+CASES = [
+    ('small_get', case_small_get),
+    ('large_get', case_large_get),
+    ('small_posts', case_small_posts),
+    ('chunked_get', case_chunked_get),
+    ('concurrent', case_concurrent),
+]
+
+def run_suite(repeat=3, only=None):
+    '''runs each case repeat times and keeps the median, returns the results as a dict'''
+    server = start_server()
+    base = 'http://127.0.0.1:%d' % server.server_address[1]
+    cases = {}
+    try:
+        for name, case in CASES:
+            if only and name not in only:
+                continue
+            runs = [case(base) for _ in range(repeat)]
+            value = statistics.median(run[0] for run in runs)
+            cases[name] = {'value': value, 'unit': runs[0][1], 'better': runs[0][2], 'runs': [run[0] for run in runs]}
+            print("%-12s %10.3f %s" % (name, value, runs[0][1]))
+    finally:
+        server.shutdown()
+        server.server_close()
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cases': cases}
+
+def compare(results, baseline, threshold):
+    '''prints each case against the baseline, returns the names of the cases that regressed by more than threshold'''
+    regressions = []
+    for name, case in results['cases'].items():
+        base = baseline['cases'].get(name)
+        if base is None or not base['value']:
+            continue
+        change = case['value'] / base['value'] - 1
+        worse = -change if case['better'] == 'higher' else change
+        flag = 'REGRESSION' if worse > threshold else ''
+        if flag:
+            regressions.append(name)
+        print("%-12s %10.3f -> %10.3f %s %+7.1f%% %s" % (name, base['value'], case['value'], case['unit'], change * 100, flag))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='httpclient performance regression suite')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare with results saved by --json')
+    parser.add_argument('--threshold', type=float, default=0.10, help='the fraction a case may get worse by (default 0.10)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case, the median is kept (default 3)')
+    parser.add_argument('--case', action='append', help='run only this case, may be repeated')
+    parser.add_argument('--micro', action='store_true', help='run the receive and header parsing micro benchmarks instead')
+    args = parser.parse_args(argv)
+
+    if args.micro:
+        bench_receive()
+        bench_headers()
+        return 0
+
+    results = run_suite(args.repeat, args.case)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("regressed: %s" % ', '.join(regressions))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())